@@ -0,0 +1,1206 @@
+"""Офлайн-бенчмарк и проверки бота на временных базах.
+
+Запуск: python bench.py КОМАНДА [АРГУМЕНТЫ]. Bot API подменяется
+заглушкой StubBotRequest, так что сеть и настоящий токен не нужны.
+"""
+import asyncio
+import collections
+import contextlib
+import http.client
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+from bot import (
+    CANDIDATE_BATCH, DB_WORKERS, FACULTIES, INSERT_PROFILE_SQL, LIKE_UPSERT_SQL, METRICS, PROFILE_OWNER_SQL,
+    SEND_BULK, SEND_INTERACTIVE, WEBHOOK_PATH, WEBHOOK_SECRET, CaptionCache, Database, DatingBot,
+    DiscoveryIndex, ProfileIdSet, ProfileRecord, SwipeBuffer, UpdateRouter, WebhookServer, backfill_matches,
+    check_query_plans, migrate, prefs_match, profile_card, record_like, restore_backup, swipe_data,
+    swipe_keyboard
+)
+
+# Бенчмарк: размеры популяций по умолчанию, лайков на анкету в среднем,
+# доля лайков среди оценок и допустимый p99 горячих обработчиков (мс)
+BENCH_SIZES = '1000'
+BENCH_LIKES_PER_PROFILE = 20
+BENCH_LIKE_RATIO = 0.7
+# Сколько пользователей действуют одновременно: при большем числе задержка
+# меряет уже очередь в event loop, а не обработчик
+BENCH_CONCURRENCY = 10
+BENCH_MAX_P99_MS = float(os.environ.get('BENCH_MAX_P99_MS', 150))
+
+# Проверка задержек: сколько секунд занимает медленный запрос и во сколько
+# раз обновления во время него должны обрабатываться быстрее
+LATENCY_SLOW_QUERY = 2.0
+LATENCY_MARGIN = 4
+
+# Лимиты поддельного Bot API по документации Telegram (сообщений в секунду
+# и всплеск): 30 в секунду на бота, в личный чат около одного в секунду с
+# короткими всплесками, в группу 20 в минуту
+FAKE_GLOBAL_LIMIT = (30, 30)
+FAKE_CHAT_LIMIT = (1, 5)
+FAKE_GROUP_LIMIT = (20 / 60, 20)
+# Допуск на задержку между планировщиком и «сервером» (с)
+FAKE_LIMIT_SLACK = 0.05
+
+
+class StubBotRequest(BaseRequest):
+    """HTTP-клиент Bot API без сети: отвечает правдоподобными объектами сразу"""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.message_id = 0
+        # chat_id -> callback_data кнопок последней показанной карточки
+        self.cards = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif endpoint == 'getFile':
+            file_id = params.get('file_id', 'file')
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'photos/{file_id}.jpg'}
+        elif endpoint.startswith(('send', 'edit')):
+            self.message_id += 1
+            markup = params.get('reply_markup')
+            if endpoint == 'sendPhoto' and markup and 'inline_keyboard' in markup:
+                self.cards[params.get('chat_id', 0)] = [
+                    button['callback_data'] for button in markup['inline_keyboard'][0]
+                ]
+            result = {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class RateLimit:
+    """Лимит rate запросов в секунду со всплеском до burst (GCRA).
+
+    Считается независимо от TokenBucket бота: по теоретическому времени
+    прихода следующего запроса.
+    """
+
+    def __init__(self, rate, burst, slack=FAKE_LIMIT_SLACK):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval + slack
+        self.arrival = 0.0
+
+    def wait(self, now):
+        """0, если запрос сейчас укладывается в лимит, иначе сколько ждать"""
+        return max(max(self.arrival, now) - now - self.tolerance, 0.0)
+
+    def take(self, now):
+        self.arrival = max(self.arrival, now) + self.interval
+
+
+class LimitedBotRequest(StubBotRequest):
+    """Заглушка Bot API, которая соблюдает флуд-лимиты Telegram.
+
+    Отправка в чат проверяется по общему лимиту бота и лимиту чата
+    (отрицательный chat_id - группа); превышение отвечает кодом 429 с
+    retry_after, как настоящий сервер, и считается в rejected. flood()
+    заставляет ответить 429 на следующий запрос в чат (в injected).
+    delivered - время доставки каждого принятого сообщения по чатам.
+    """
+
+    def __init__(self, global_limit=FAKE_GLOBAL_LIMIT, chat_limit=FAKE_CHAT_LIMIT, group_limit=FAKE_GROUP_LIMIT):
+        super().__init__()
+        self.global_limit = RateLimit(*global_limit)
+        self.chat_limit = chat_limit
+        self.group_limit = group_limit
+        self.chat_limits = {}
+        self.flooded = {}
+        self.rejected = 0
+        self.injected = 0
+        self.delivered = collections.defaultdict(list)
+
+    def flood(self, chat_id, seconds):
+        self.flooded[chat_id] = seconds
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        chat_id = request_data.parameters.get('chat_id') if request_data else None
+        if chat_id is None or not endpoint.startswith(('send', 'edit', 'copy', 'forward')):
+            return await super().do_request(url, method, request_data, **kwargs)
+        chat_id = int(chat_id)
+        if chat_id in self.flooded:
+            self.injected += 1
+            return self._too_many(self.flooded.pop(chat_id))
+        chat = self.chat_limits.get(chat_id)
+        if chat is None:
+            chat = self.chat_limits[chat_id] = RateLimit(*(self.group_limit if chat_id < 0 else self.chat_limit))
+        now = time.monotonic()
+        wait = max(self.global_limit.wait(now), chat.wait(now))
+        if wait:
+            self.rejected += 1
+            return self._too_many(wait)
+        self.global_limit.take(now)
+        chat.take(now)
+        self.delivered[chat_id].append(now)
+        return await super().do_request(url, method, request_data, **kwargs)
+
+    @staticmethod
+    def _too_many(seconds):
+        retry_after = max(1, math.ceil(seconds))
+        return 429, json.dumps({
+            'ok': False, 'error_code': 429,
+            'description': f'Too Many Requests: retry after {retry_after}',
+            'parameters': {'retry_after': retry_after}
+        }).encode()
+
+
+def seed_bench_db(path, size, likes_per_profile=BENCH_LIKES_PER_PROFILE):
+    """База с size анкетами и графом лайков: популярность анкет убывает по степенному закону"""
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    faculties = list(FACULTIES.values())
+    words = ['спорт', 'кино', 'музыка', 'книги', 'путешествия', 'кофе', 'код', 'горы', 'танцы']
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
+            ((user_id, f'user{user_id}', f'User{user_id}') for user_id in range(1, size + 1))
+        )
+        conn.executemany(
+            INSERT_PROFILE_SQL,
+            ((user_id, f'User{user_id}', f'photo{user_id}', random.choice(['male', 'female']),
+              random.choice(faculties), random.randint(17, 30),
+              ' '.join(random.choices(words, k=random.randint(3, 30))))
+             for user_id in range(1, size + 1))
+        )
+
+    def likes():
+        for user_id in range(1, size + 1):
+            # Разные анкеты: при 100 лайках на анкету 100k анкет дают ровно 10M лайков
+            targets = set()
+            while len(targets) < min(likes_per_profile, size - 1):
+                target = int(size * random.random() ** 3) + 1
+                if target != user_id:
+                    targets.add(target)
+            for target in targets:
+                yield user_id, target, random.random() < BENCH_LIKE_RATIO
+
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO likes (from_user_id, to_profile_id, is_like) VALUES (?, ?, ?)', likes())
+        backfill_matches(conn.cursor())
+    conn.close()
+
+
+def copy_db(source, target):
+    """Копия базы через backup API (целая, даже если source открыта ботом)"""
+    source, target = sqlite3.connect(source), sqlite3.connect(target)
+    source.backup(target)
+    source.close()
+    target.close()
+
+
+def bench_seed(bench_dir, size, likes_per_profile=BENCH_LIKES_PER_PROFILE):
+    """Путь к синтетической базе в bench_dir: создается один раз и переиспользуется"""
+    bench_dir = bench_dir or os.path.join(tempfile.gettempdir(), 'dating_bot_bench')
+    os.makedirs(bench_dir, exist_ok=True)
+    path = os.path.join(bench_dir, f'seed_{size}_{likes_per_profile}.db')
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        seed_bench_db(path + '.tmp', size, likes_per_profile)
+        os.replace(path + '.tmp', path)
+        print(f"🌱 База на {size} анкет по {likes_per_profile} лайков создана за {time.perf_counter() - started:.1f} с")
+    return path
+
+
+@contextlib.contextmanager
+def temp_db(size=0, source=None):
+    """Путь к базе во временном каталоге: копия source или синтетическая на size анкет.
+
+    Каталог удаляется на выходе, туда же можно класть другие файлы проверки.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        if source and os.path.exists(source):
+            copy_db(source, path)
+        elif size:
+            seed_bench_db(path, size)
+        yield path
+
+
+# Обработчики шагов BenchClient.registration, по порядку
+REGISTRATION_HANDLERS = ('start', 'start_create_profile', 'handle_name', 'handle_photo', 'handle_callback',
+                         'handle_age', 'handle_callback', 'handle_bio')
+
+
+class BenchClient:
+    """Отправляет в приложение синтетические обновления и замеряет время обработки"""
+
+    def __init__(self, application):
+        self.application = application
+        self.update_id = 0
+        self.latencies = collections.defaultdict(list)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def _message(self, user_id, **fields):
+        self.update_id += 1
+        return {
+            'message_id': self.update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            **fields
+        }
+
+    async def _process(self, name, data):
+        update = Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies[name].append(time.perf_counter() - started)
+
+    def text_update(self, user_id, text):
+        """Обновление-сообщение (dict, как в Bot API)"""
+        fields = {'text': text}
+        if text.startswith('/'):
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        message = self._message(user_id, **fields)
+        return {'update_id': self.update_id, 'message': message}
+
+    def photo_update(self, user_id):
+        photo = [{'file_id': f'photo{user_id}', 'file_unique_id': f'unique{user_id}', 'width': 640, 'height': 640}]
+        message = self._message(user_id, photo=photo)
+        return {'update_id': self.update_id, 'message': message}
+
+    def press_update(self, user_id, data):
+        """Обновление-нажатие кнопки с callback_data data"""
+        message = self._message(user_id, text='card')
+        return {
+            'update_id': self.update_id,
+            'callback_query': {
+                'id': str(self.update_id),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': message
+            }
+        }
+
+    def registration(self, user_id):
+        """Обновления создания анкеты от /start до «О себе» по порядку"""
+        return [
+            self.text_update(user_id, '/start'),
+            self.text_update(user_id, "👤 Создать анкету"),
+            self.text_update(user_id, f'User{user_id}'),
+            self.photo_update(user_id),
+            self.press_update(user_id, random.choice(['gender_male', 'gender_female'])),
+            self.text_update(user_id, str(random.randint(17, 30))),
+            self.press_update(user_id, f'faculty_{random.choice(list(FACULTIES))}'),
+            self.text_update(user_id, 'Люблю бенчмарки'),
+        ]
+
+    async def text(self, name, user_id, text):
+        await self._process(name, self.text_update(user_id, text))
+
+    async def photo(self, name, user_id):
+        await self._process(name, self.photo_update(user_id))
+
+    async def press(self, name, user_id, data):
+        await self._process(name, self.press_update(user_id, data))
+
+    async def swipes(self, user_id, count, request, like_ratio=BENCH_LIKE_RATIO):
+        """Открыть поиск и сделать до count свайпов по кнопкам показанных карточек"""
+        await self.text('find_profile', user_id, "🔍 Найти анкету")
+        for _ in range(count):
+            card = request.cards.pop(user_id, None)
+            if not card:
+                break
+            like, dislike = card
+            await self.press('handle_like', user_id, like if random.random() < like_ratio else dislike)
+
+
+@contextlib.asynccontextmanager
+async def stub_bot(path, request=None, rate_limiter=False):
+    """Запущенный DatingBot на базе path с заглушкой Bot API: (bot, request, client)"""
+    bot = DatingBot(path)
+    request = request or StubBotRequest()
+    application = bot.build_application(token='0:bench', request=request, rate_limiter=rate_limiter)
+    await application.initialize()
+    await bot.on_startup(application)
+    try:
+        yield bot, request, BenchClient(application)
+    finally:
+        await bot.on_shutdown(application)
+        await application.shutdown()
+
+
+def percentile(values, q):
+    """Квантиль q отсортированного списка секунд, в миллисекундах"""
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+def report(problems, success):
+    """Напечатать ❌ по каждой проблеме (первые 20) или ✅ success, вернуть код выхода"""
+    for problem in problems[:20]:
+        print(f"❌ {problem}")
+    if not problems:
+        print(f"✅ {success}")
+    return 1 if problems else 0
+
+
+async def run_bench(path, size, users, swipes, concurrency=BENCH_CONCURRENCY):
+    """Прогнать смешанную нагрузку на базе path, вернуть (фазы, задержки по обработчикам)"""
+    phases = []
+    slots = asyncio.Semaphore(concurrency)
+    async with stub_bot(path) as (bot, request, client):
+
+        async def session(scenario, user_id):
+            async with slots:
+                await scenario(user_id)
+
+        async def phase(name, user_ids, scenario):
+            started = time.perf_counter()
+            before = sum(map(len, client.latencies.values()))
+            await asyncio.gather(*(session(scenario, user_id) for user_id in user_ids))
+            updates = sum(map(len, client.latencies.values())) - before
+            phases.append((name, updates, time.perf_counter() - started))
+
+        async def register(user_id):
+            for name, data in zip(REGISTRATION_HANDLERS, client.registration(user_id)):
+                await client._process(name, data)
+
+        async def swipe(user_id):
+            await client.swipes(user_id, swipes, request)
+
+        async def view_matches(user_id):
+            await client.text('show_matches', user_id, "💝 Мои мэтчи")
+            await client.press('handle_matches_page', user_id, 'matches_next_0')
+
+        active = random.sample(range(1, size + 1), min(users, size))
+        await phase('registration', range(size + 1, size + users + 1), register)
+        await phase('swipe storm', active, swipe)
+        await phase('match viewing', active, view_matches)
+    return phases, client.latencies
+
+
+def bench_command(sizes=BENCH_SIZES, users='200', swipes='20', bench_dir=None,
+                  concurrency=str(BENCH_CONCURRENCY), likes=str(BENCH_LIKES_PER_PROFILE)):
+    """python bench.py bench [РАЗМЕРЫ] [USERS] [SWIPES] [DIR] [ПАРАЛЛЕЛЬНО] [ЛАЙКОВ]: офлайн-бенчмарк обработчиков.
+
+    Для каждого размера (через запятую, например 1000,100000,1000000)
+    создает базу с синтетическими анкетами и ЛАЙКОВ лайками на анкету
+    (повторно используется из DIR), подменяет Bot API заглушкой и прогоняет
+    регистрацию USERS новых пользователей, по SWIPES свайпов от USERS
+    существующих и просмотр мэтчей, по ПАРАЛЛЕЛЬНО пользователей
+    одновременно. Печатает пропускную способность фаз и
+    p50/p99 по обработчикам; код выхода 1, если p99 find_profile или
+    handle_like больше BENCH_MAX_P99_MS.
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    problems = []
+    for size in (int(value) for value in sizes.split(',')):
+        seed_path = bench_seed(bench_dir, size, int(likes))
+        # Прогон идет на копии, чтобы повторные запуски были сопоставимы
+        path = os.path.join(os.path.dirname(seed_path), f'run_{size}.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        copy_db(seed_path, path)
+
+        random.seed(size)
+        phases, latencies = asyncio.run(run_bench(path, size, int(users), int(swipes), int(concurrency)))
+        print(f"\n📊 {size} анкет")
+        for name, updates, elapsed in phases:
+            print(f"  {name:<16} {updates:>7} обновлений за {elapsed:6.2f} с  {updates / elapsed:8.0f}/с")
+        for name, values in sorted(latencies.items()):
+            values.sort()
+            p50, p99 = percentile(values, 0.5), percentile(values, 0.99)
+            print(f"  {name:<22} n={len(values):<7} p50={p50:7.2f} мс  p99={p99:7.2f} мс")
+            if name in ('find_profile', 'handle_like') and p99 > BENCH_MAX_P99_MS:
+                problems.append(f"{size} анкет, {name}: p99 {p99:.1f} мс больше {BENCH_MAX_P99_MS:.0f} мс")
+    print()
+    return report(problems, f"p99 find_profile и handle_like не больше {BENCH_MAX_P99_MS:.0f} мс")
+
+
+def bench_candidates_command(size='100000', likes='100', users='100', cards='100', bench_dir=None):
+    """python bench.py bench-candidates [РАЗМЕР] [ЛАЙКОВ] [USERS] [CARDS] [DIR]: выбор анкет на большой базе.
+
+    На синтетической базе с РАЗМЕР анкетами по ЛАЙКОВ лайков (по умолчанию
+    100k анкет и 10M лайков, база переиспользуется из DIR) USERS
+    пользователей листают по CARDS анкет, оценивая каждую, как это делает
+    handle_like. Первая анкета загружает просмотренные и входящие лайки,
+    остальные берутся из очереди с фоновой дозагрузкой. Печатает p50/p99
+    первой и следующих анкет; код выхода 1, если p99 следующих больше
+    BENCH_MAX_P99_MS.
+    """
+    size, users, cards = int(size), int(users), int(cards)
+    seed_path = bench_seed(bench_dir, size, int(likes))
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def measure(path):
+        first, rest = [], []
+        async with stub_bot(path) as (bot, _, _):
+            for user_id in random.sample(range(1, size + 1), users):
+                for n in range(cards):
+                    started = time.perf_counter()
+                    card = await bot.candidates.next(user_id)
+                    (rest if n else first).append(time.perf_counter() - started)
+                    if card is None:
+                        break
+                    bot.seen.add(user_id, card['profile_id'])
+                    await bot.swipes.add(user_id, card['profile_id'], card['user_id'], random.random() < BENCH_LIKE_RATIO)
+            seen_bytes = bot.seen.nbytes
+        return sorted(first), sorted(rest), seen_bytes, METRICS.histograms.get(('candidate_refill_seconds', ()))
+
+    with temp_db(source=seed_path) as path:
+        random.seed(size)
+        first, rest, seen_bytes, refills = asyncio.run(measure(path))
+    print(f"{size} анкет, {users} пользователей по {cards} анкет, множества просмотренных {seen_bytes / 1024:.0f} КБ")
+    for name, values in (('первая анкета', first), ('следующие', rest)):
+        print(f"  {name:<14} n={len(values):<6} p50={percentile(values, 0.5):7.2f} мс  p99={percentile(values, 0.99):7.2f} мс")
+    if refills:
+        print(f"  {'дозагрузка':<14} n={refills.count:<6} p50={refills.quantile(0.5) * 1000:7.2f} мс  "
+              f"p99={refills.quantile(0.99) * 1000:7.2f} мс")
+    p99 = percentile(rest, 0.99)
+    problems = [f"p99 следующей анкеты {p99:.1f} мс больше {BENCH_MAX_P99_MS:.0f} мс"] if p99 > BENCH_MAX_P99_MS else []
+    return report(problems, f"p99 следующей анкеты не больше {BENCH_MAX_P99_MS:.0f} мс")
+
+
+def bench_db_command(size='5000', count='2000'):
+    """python bench.py bench-db [РАЗМЕР] [N]: соединение на каждый запрос против пула Database.
+
+    На временной базе с РАЗМЕР анкетами по N раз выполняет поиск анкеты по
+    ключу и вставку одной оценки двумя способами: как до пула (connect,
+    запрос, commit и close на каждый вызов) и через постоянные соединения
+    Database. Оба способа выполняются в потоках и ожидаются из event loop,
+    так что разница - только цена соединения. Печатает среднее и p99 в
+    микросекундах; код выхода 1, если пул медленнее.
+    """
+    size, count = int(size), int(count)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def per_request(path, sql, params):
+        conn = sqlite3.connect(path)
+        try:
+            result = conn.execute(sql, params).fetchall()
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    async def measure(path):
+        db = Database(path)
+        loop = asyncio.get_running_loop()
+        pool = ThreadPoolExecutor(max_workers=DB_WORKERS)
+        cases = (
+            ('поиск по ключу', PROFILE_OWNER_SQL, False, lambda: (random.randint(1, size),)),
+            ('вставка оценки', LIKE_UPSERT_SQL, True,
+             lambda: (random.randint(1, size), random.randint(1, size), random.random() < BENCH_LIKE_RATIO)),
+        )
+        results = []
+        try:
+            for name, sql, write, params in cases:
+                before, after = [], []
+                # Способы чередуются, чтобы на них одинаково влиял прогрев кэша
+                for _ in range(count):
+                    started = time.perf_counter()
+                    await loop.run_in_executor(pool, per_request, path, sql, params())
+                    before.append(time.perf_counter() - started)
+                    args = params()
+                    started = time.perf_counter()
+                    await db.run(lambda cursor: cursor.execute(sql, args).fetchall(), write=write)
+                    after.append(time.perf_counter() - started)
+                results.append((name, sorted(before), sorted(after)))
+        finally:
+            pool.shutdown()
+            db.close()
+        return results
+
+    with temp_db(size) as path:
+        results = asyncio.run(measure(path))
+    problems = []
+    for name, before, after in results:
+        mean_before, mean_after = sum(before) / count * 1e6, sum(after) / count * 1e6
+        print(f"{name:<16} на запрос: {mean_before:7.0f} мкс (p99 {percentile(before, 0.99) * 1000:6.0f} мкс)  "
+              f"пул: {mean_after:7.0f} мкс (p99 {percentile(after, 0.99) * 1000:6.0f} мкс)")
+        if mean_after > mean_before:
+            problems.append(f"{name}: пул медленнее соединения на запрос")
+    return report(problems, "Пул соединений быстрее соединения на каждый запрос")
+
+
+def bench_swipes_command(size='5000', rate='1000', seconds='3'):
+    """python bench.py bench-swipes [РАЗМЕР] [RATE] [СЕКУНД]: запись свайпов по одному и пачками.
+
+    На копиях временной базы с РАЗМЕР анкетами подает RATE свайпов в
+    секунду в течение СЕКУНД секунд двумя способами: каждый свайп своей
+    транзакцией record_like (как до SwipeBuffer) и через SwipeBuffer.
+    Печатает, сколько свайпов в секунду записано, и p99 ответа на свайп,
+    а также предел каждого способа, когда все свайпы приходят сразу; код
+    выхода 1, если SwipeBuffer не держит RATE.
+    """
+    size, rate, seconds = int(size), int(rate), float(seconds)
+    total = int(rate * seconds)
+    logging.getLogger().setLevel(logging.WARNING)
+    swipes = [(random.randint(1, size), random.randint(1, size), random.random() < BENCH_LIKE_RATIO)
+              for _ in range(total)]
+
+    async def replay(path, buffered, rate):
+        db = Database(path)
+        owners = dict(await db.fetchall('SELECT profile_id, user_id FROM profiles'))
+        buffer = SwipeBuffer(db)
+        buffer.start()
+        latencies = []
+
+        async def swipe(index, user_id, profile_id, is_like):
+            # Открытая нагрузка: свайп приходит в свое время, даже если прошлые еще не записаны
+            if rate:
+                await asyncio.sleep(started + index / rate - time.perf_counter())
+            submitted = time.perf_counter()
+            if buffered:
+                await buffer.add(user_id, profile_id, owners[profile_id], is_like)
+            else:
+                await db.run(record_like, user_id, profile_id, is_like)
+            latencies.append(time.perf_counter() - submitted)
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(swipe(index, *args) for index, args in enumerate(swipes)))
+            await buffer.stop()
+            elapsed = time.perf_counter() - started
+        finally:
+            db.close()
+        return elapsed, sorted(latencies)
+
+    problems = []
+    with temp_db(size) as seed:
+        path = os.path.join(os.path.dirname(seed), 'swipes.db')
+        for name, buffered in (('по одному', False), ('SwipeBuffer', True)):
+            for target in (rate, None):
+                copy_db(seed, path)
+                elapsed, latencies = asyncio.run(replay(path, buffered, target))
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                throughput = total / elapsed
+                mode = f'{target}/с' if target else 'все сразу'
+                print(f"{name:<12} {mode:<10} записано {throughput:6.0f}/с, "
+                      f"ответ p50={percentile(latencies, 0.5):7.1f} мс p99={percentile(latencies, 0.99):7.1f} мс")
+                if buffered and target and throughput < target * 0.95:
+                    problems.append(f"SwipeBuffer записывает {throughput:.0f} свайпов в секунду из {target}")
+    return report(problems, f"SwipeBuffer держит {rate} свайпов в секунду")
+
+
+def bench_filters_command(size='100000', count='1000'):
+    """python bench.py bench-filters [РАЗМЕР] [N]: выбор анкет по узкому и широкому фильтру.
+
+    Заполняет DiscoveryIndex РАЗМЕР синтетическими анкетами и N раз
+    выбирает пачку CANDIDATE_BATCH анкет, как Recommender: пробы sample,
+    затем scan. Фильтры: «пол, один факультет, два возраста» и «только
+    пол»; каждый для нового пользователя и для того, кто уже видел 90%
+    подходящих анкет. Печатает p50/p99 в мс; код выхода 1, если p99
+    больше BENCH_MAX_P99_MS.
+    """
+    size, count = int(size), int(count)
+    faculties = list(FACULTIES.values())
+    index = DiscoveryIndex()
+    for profile_id in range(1, size + 1):
+        index.add(profile_id, profile_id, random.choice(['male', 'female']), random.choice(faculties),
+                  random.randint(17, 30))
+    filters = (
+        ('узкий', {'gender': 'female', 'faculties': ['ИУ'], 'age_min': 19, 'age_max': 20}),
+        ('широкий', {'gender': 'female'}),
+    )
+
+    def pick(prefs, seen):
+        found = index.sample(prefs, 0, CANDIDATE_BATCH, seen=seen)
+        cursor = {}
+        while len(found) < CANDIDATE_BATCH:
+            more, done = index.scan(prefs, 0, CANDIDATE_BATCH - len(found), cursor, set(found), seen)
+            found.extend(more)
+            if done:
+                break
+        return found
+
+    problems = []
+    for name, prefs in filters:
+        matching = [profile_id for profile_id, (key, _, _) in index.entries.items() if prefs_match(prefs, *key)]
+        seen_most = ProfileIdSet(random.sample(matching, len(matching) * 9 // 10))
+        for viewer, seen in (('новый', ()), ('видел 90%', seen_most)):
+            timings = []
+            for _ in range(count):
+                started = time.perf_counter()
+                pick(prefs, seen)
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            p50, p99 = percentile(timings, 0.5), percentile(timings, 0.99)
+            print(f"{name:<8} ({len(matching):>6} анкет) {viewer:<10} p50={p50:6.2f} мс p99={p99:6.2f} мс")
+            if p99 > BENCH_MAX_P99_MS:
+                problems.append(f"Фильтр {name}, {viewer}: p99 {p99:.1f} мс больше {BENCH_MAX_P99_MS:.0f} мс")
+    return report(problems, f"Выбор по фильтрам не дольше {BENCH_MAX_P99_MS:.0f} мс")
+
+
+def bench_render_command(count='20000', profiles='1000'):
+    """python bench.py bench-render [N] [АНКЕТ]: время и память на отрисовку карточки свайпа.
+
+    Собирает карточку (profile_card) и кнопки (swipe_keyboard) по кругу для
+    АНКЕТ анкет, без кэша подписей и с прогретым CaptionCache. Печатает
+    время на свайп (N свайпов) и по tracemalloc: пик памяти, выделенной
+    за свайп, и сколько блоков памяти остается на карточку с кнопками;
+    код выхода 1, если с кэшем выделяется больше.
+    """
+    count, profiles = int(count), int(profiles)
+    faculties = list(FACULTIES.values())
+    records = [
+        ProfileRecord(profile_id, profile_id, f'User{profile_id}', f'photo{profile_id}',
+                      random.choice(['male', 'female']), random.choice(faculties), random.randint(17, 30),
+                      'Люблю кино, музыку и путешествия', None)
+        for profile_id in range(1, profiles + 1)
+    ]
+    # Выделения самого tracemalloc (снимки) не считаются
+    own = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+    def swipe(n, captions):
+        card = profile_card(records[n % profiles], f'user{n % profiles}', captions)
+        return card, swipe_keyboard(1, card)
+
+    def measure(captions):
+        started = time.perf_counter()
+        for n in range(count):
+            swipe(n, captions)
+        elapsed = (time.perf_counter() - started) / count
+        tracemalloc.start()
+        try:
+            peak = 0
+            for n in range(profiles):
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                swipe(n, captions)
+                peak += tracemalloc.get_traced_memory()[1] - before
+            before = tracemalloc.take_snapshot().filter_traces(own)
+            kept = [swipe(n, captions) for n in range(profiles)]
+            after = tracemalloc.take_snapshot().filter_traces(own)
+            blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+        finally:
+            tracemalloc.stop()
+        del kept
+        return elapsed, peak / profiles, blocks / profiles
+
+    results = {}
+    for name, captions in (('без кэша', None), ('CaptionCache', CaptionCache())):
+        results[name] = measure(captions)
+        elapsed, peak, blocks = results[name]
+        print(f"{name:<14} {elapsed * 1e6:6.1f} мкс на свайп, пик {peak:6.0f} байт, блоков на карточку {blocks:5.1f}")
+    problems = []
+    if results['CaptionCache'][1] > results['без кэша'][1]:
+        problems.append("С CaptionCache на свайп выделяется больше памяти, чем без него")
+    return report(problems, "CaptionCache уменьшает выделения памяти на свайп")
+
+
+def check_workers_command(workers='4', users='200', swipes='20'):
+    """python bench.py check-workers [WORKERS] [USERS] [SWIPES]: проверка многопроцессного режима.
+
+    На временной базе с USERS анкетами запускает роутер с WORKERS
+    воркерами и заглушкой Bot API, перемешивает между пользователями
+    «🔍 Найти анкету» и по SWIPES подписанных карточек разных еще не
+    оцененных анкет. На каждой карточке нажимается «лайк», а сразу за ним
+    «дизлайк»: окно идемпотентности должно отбросить второе нажатие.
+    Проверяет, что у каждого пользователя записано ровно SWIPES новых
+    оценок и все они лайки.
+    """
+    workers, users, swipes = int(workers), int(users), int(swipes)
+    logging.getLogger().setLevel(logging.WARNING)
+    ratings_sql = 'SELECT from_user_id, COUNT(*), SUM(NOT is_like) FROM likes GROUP BY from_user_id'
+    with temp_db(users) as path:
+        conn = sqlite3.connect(path)
+        before = {user_id: (count, dislikes) for user_id, count, dislikes in conn.execute(ratings_sql)}
+
+        owners = dict(conn.execute('SELECT profile_id, user_id FROM profiles').fetchall())
+        rated = collections.defaultdict(set)
+        for user_id, profile_id in conn.execute('SELECT from_user_id, to_profile_id FROM likes'):
+            rated[user_id].add(profile_id)
+
+        client = BenchClient(None)
+        streams = []
+        for user_id in range(1, users + 1):
+            stream = [client.text_update(user_id, "🔍 Найти анкету")]
+            unrated = [profile_id for profile_id, owner_id in owners.items()
+                       if owner_id != user_id and profile_id not in rated[user_id]]
+            for profile_id in random.sample(unrated, min(swipes, len(unrated))):
+                for action in ('like', 'dislike'):
+                    data = swipe_data(user_id, action, profile_id, owners[profile_id])
+                    stream.append(client.press_update(user_id, data))
+            streams.append(collections.deque(stream))
+
+        router = UpdateRouter(workers, path, token='0:bench', request_class=StubBotRequest)
+        router.start()
+        started = time.perf_counter()
+        update_id = 0
+        while streams:
+            stream = random.choice(streams)
+            update_id += 1
+            data = stream.popleft()
+            data['update_id'] = update_id
+            router.route(data)
+            if not stream:
+                streams.remove(stream)
+        exitcodes = router.stop()
+        elapsed = time.perf_counter() - started
+
+        after = {user_id: (count, dislikes) for user_id, count, dislikes in conn.execute(ratings_sql)}
+        conn.close()
+    print(f"Воркеров: {workers}, обновлений: {update_id} за {elapsed:.2f} с ({update_id / elapsed:.0f}/с)")
+    problems = [f"Коды выхода воркеров: {exitcodes}"] if any(exitcodes) else []
+    for user_id in range(1, users + 1):
+        count, dislikes = (a - b for a, b in zip(after.get(user_id, (0, 0)), before.get(user_id, (0, 0))))
+        if count != swipes:
+            problems.append(f"Пользователь {user_id}: записано {count} оценок из {swipes}")
+        elif dislikes:
+            problems.append(f"Пользователь {user_id}: {dislikes} повторных нажатий «дизлайк» не отброшены")
+    return report(problems, f"Все {users * swipes} оценок записаны по одному разу, повторные нажатия отброшены")
+
+
+def check_backup_command(size='20000', users='200', swipes='50'):
+    """python bench.py check-backup [РАЗМЕР] [USERS] [SWIPES]: резервная копия во время потока свайпов.
+
+    На временной базе с РАЗМЕР анкетами USERS пользователей делают по
+    SWIPES свайпов через обработчики (Bot API — заглушка), а посреди потока
+    снимается копия. Проверяет целостность копии, что лайков в ней не
+    меньше, чем до потока, и не больше, чем после, и что восстановленная
+    копия открывается ботом. Печатает p99 handle_like во время копирования.
+    """
+    size, users, swipes = int(size), int(users), int(swipes)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def storm(path, backup_dir):
+        async with stub_bot(path) as (bot, request, client):
+            slots = asyncio.Semaphore(BENCH_CONCURRENCY)
+
+            async def swipe(user_id):
+                async with slots:
+                    await client.swipes(user_id, swipes, request, like_ratio=0.5)
+
+            task = asyncio.ensure_future(asyncio.gather(
+                *(swipe(user_id) for user_id in random.sample(range(1, size + 1), users))
+            ))
+            await asyncio.sleep(1)
+            likes = client.latencies['handle_like']
+            first = len(likes)
+            started = time.perf_counter()
+            backup_path = await bot.backup(backup_dir=backup_dir)
+            elapsed = time.perf_counter() - started
+            during = sorted(likes[first:])
+            await task
+        return backup_path, elapsed, during, sorted(likes)
+
+    def count_likes(path):
+        conn = sqlite3.connect(path)
+        (count,) = conn.execute('SELECT COUNT(*) FROM likes').fetchone()
+        conn.close()
+        return count
+
+    with temp_db(size) as path:
+        tmp = os.path.dirname(path)
+        before = count_likes(path)
+        backup_path, elapsed, during, likes = asyncio.run(storm(path, os.path.join(tmp, 'backups')))
+        after = count_likes(path)
+
+        restored = os.path.join(tmp, 'restored.db')
+        restore_backup(backup_path, restored)
+        copied = count_likes(restored)
+        bot = DatingBot(restored)
+        bot.db.close()
+
+        print(f"Копия {os.path.getsize(backup_path) / 2**20:.1f} МБ (база {os.path.getsize(path) / 2**20:.1f} МБ) "
+              f"за {elapsed:.2f} с, свайпов за это время: {len(during)}")
+        print(f"handle_like p99: во время копии {percentile(during, 0.99):.1f} мс, "
+              f"за весь поток {percentile(likes, 0.99):.1f} мс")
+    problems = [] if before <= copied <= after else [f"Лайков в копии {copied}, а до потока {before}, после {after}"]
+    return report(problems, f"Копия целая: лайков {copied} (до потока {before}, после {after})")
+
+
+def slow_query(cursor, rows):
+    """Запрос, который долго считает внутри SQLite (как полный проход по большой таблице)"""
+    return cursor.execute(
+        'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < ?) SELECT COUNT(*) FROM c',
+        (rows,)
+    ).fetchone()[0]
+
+
+def check_latency_command(size='2000', users='50', swipes='10'):
+    """python bench.py check-latency [РАЗМЕР] [USERS] [SWIPES]: обработчики не ждут чужих запросов к БД.
+
+    На временной базе с РАЗМЕР анкетами занимает поток записи и один поток
+    чтения медленным запросом на LATENCY_SLOW_QUERY секунд и в это время
+    прогоняет по SWIPES свайпов от USERS пользователей. Если обработчики
+    выстраиваются за запросом, каждый ждет его целиком; проверка требует,
+    чтобы p99 handle_like был в LATENCY_MARGIN раз меньше. Печатает и
+    самую долгую паузу между итерациями event loop.
+    """
+    size, users, swipes = int(size), int(users), int(swipes)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def measure(path):
+        async with stub_bot(path) as (bot, request, client):
+            # Подбираем число строк так, чтобы запрос шел LATENCY_SLOW_QUERY секунд
+            started = time.perf_counter()
+            await bot.db.run(slow_query, 100000, write=False)
+            rows = int(100000 * LATENCY_SLOW_QUERY / (time.perf_counter() - started))
+
+            active = random.sample(range(1, size + 1), users)
+            for user_id in active:
+                await client.text('find_profile', user_id, "🔍 Найти анкету")
+            client.latencies.clear()
+
+            stalls = []
+
+            async def ticker():
+                last = time.perf_counter()
+                while True:
+                    await asyncio.sleep(0.01)
+                    now = time.perf_counter()
+                    stalls.append(now - last - 0.01)
+                    last = now
+
+            slots = asyncio.Semaphore(BENCH_CONCURRENCY)
+
+            async def swipe(user_id):
+                async with slots:
+                    await client.swipes(user_id, swipes, request)
+
+            tick = asyncio.ensure_future(ticker())
+            started = time.perf_counter()
+            slow = asyncio.gather(bot.db.run(slow_query, rows, write=False), bot.db.run(slow_query, rows))
+            await asyncio.gather(*(swipe(user_id) for user_id in active))
+            swiped = time.perf_counter() - started
+            await slow
+            elapsed = time.perf_counter() - started
+            tick.cancel()
+        return elapsed, swiped, sorted(client.latencies['handle_like']), max(stalls)
+
+    with temp_db(size) as path:
+        elapsed, swiped, likes, stall = asyncio.run(measure(path))
+    p50, p99 = percentile(likes, 0.5), percentile(likes, 0.99)
+    print(f"Медленные запросы (чтение и запись) шли {elapsed:.2f} с; {len(likes)} свайпов за {swiped:.2f} с")
+    print(f"handle_like p50={p50:.1f} мс p99={p99:.1f} мс, самая долгая пауза event loop {stall * 1000:.1f} мс")
+    limit = elapsed * 1000 / LATENCY_MARGIN
+    problems = []
+    if p99 > limit:
+        problems.append(f"p99 handle_like {p99:.1f} мс больше {limit:.0f} мс: обработчики ждут медленный запрос")
+    return report(problems, "Обработчики не выстраиваются за медленными запросами к БД")
+
+
+def check_plans_command(db_name='dating_bot.db'):
+    """python bench.py check-plans [DB]: ненулевой код выхода, если горячий запрос читает лишние строки.
+
+    Запрос не должен сканировать таблицу (даже по индексу), а запрос на
+    одну строку - искать по неполному ключу. Смотрит планы на копии базы,
+    так что саму DB не мигрирует.
+    """
+    with temp_db(source=db_name) as path:
+        conn = sqlite3.connect(path)
+        migrate(conn)
+        slow = check_query_plans(conn)
+        conn.close()
+    return report([f"{name}: {detail}" for name, detail in slow],
+                  "Все горячие запросы ищут по индексам")
+
+
+def check_snapshot_command(db_name='dating_bot.db', operations='1000'):
+    """python bench.py check-snapshot [DB] [N]: сверить снимок анкет с БД после N случайных изменений.
+
+    Работает на копии базы: создает и удаляет анкеты через те же методы,
+    что и обработчики, и сравнивает снимок в памяти с таблицей profiles.
+    """
+    async def check(path):
+        async with stub_bot(path) as (bot, _, _):
+            users = [user_id for (user_id,) in await bot.db.fetchall('SELECT user_id FROM users')]
+            users = users or list(range(1, 101))
+            for _ in range(int(operations)):
+                user_id = random.choice(users)
+                if bot.profiles.profile_of(user_id) and random.random() < 0.5:
+                    await bot.remove_profiles(user_id)
+                else:
+                    await bot.create_profile((
+                        user_id, f'user{user_id}', 'photo', random.choice(['male', 'female']),
+                        random.choice(list(FACULTIES.values())), random.randint(16, 40), 'bio'
+                    ))
+            problems = await bot.db.run(bot.profiles.diff, write=False)
+            indexed = bot.discovery.entries.keys() == bot.profiles.records.keys()
+        return problems, indexed
+
+    with temp_db(source=db_name) as path:
+        problems, indexed = asyncio.run(check(path))
+    problems = [f"{profile_id}: в памяти {mine}, в БД {actual}" for profile_id, mine, actual in problems]
+    if not indexed:
+        problems.append("Индекс поиска не совпадает со снимком")
+    return report(problems, f"Снимок совпадает с БД после {operations} изменений")
+
+
+def check_send_command(chats='60', messages='3'):
+    """python bench.py check-send [ЧАТЫ] [СООБЩЕНИЙ]: SendScheduler против Bot API с флуд-лимитами.
+
+    Отправляет сообщения через приложение бота в заглушку LimitedBotRequest
+    и проверяет, что без планировщика она отвечает 429 (лимиты работают),
+    а с ним: по СООБЩЕНИЙ в ЧАТЫ разных чатов, всплеск в один чат и в
+    группу проходят без единого 429; ответы пользователям обгоняют
+    очередь рассылки; после RetryAfter запрос повторяется через retry_after.
+    """
+    chats, messages = int(chats), int(messages)
+    logging.getLogger().setLevel(logging.ERROR)
+    problems = []
+
+    async def send(bot, chat_id, priority=SEND_INTERACTIVE):
+        # Без планировщика telegram не принимает rate_limit_args
+        extra = {'rate_limit_args': {'priority': priority}} if bot.rate_limiter else {}
+        await bot.send_message(chat_id, 'check', **extra)
+        return time.monotonic()
+
+    async def unlimited(path):
+        async with stub_bot(path, LimitedBotRequest()) as (_, request, client):
+            results = await asyncio.gather(
+                *(send(client.application.bot, 1) for _ in range(10)), return_exceptions=True
+            )
+        flooded = sum(isinstance(result, RetryAfter) for result in results)
+        print(f"Без планировщика: 10 сообщений в один чат, 429 получили {flooded}")
+        problems.extend(repr(result) for result in results
+                        if isinstance(result, Exception) and not isinstance(result, RetryAfter))
+        if not flooded:
+            problems.append("Заглушка не ответила 429 на всплеск в один чат")
+
+    async def throttled(path):
+        async with stub_bot(path, LimitedBotRequest(), rate_limiter=True) as (_, request, client):
+            bot = client.application.bot
+            started = time.monotonic()
+            await asyncio.gather(
+                *(send(bot, chat_id) for chat_id in range(1, chats + 1) for _ in range(messages)),
+                *(send(bot, chats + 1) for _ in range(8)),
+                *(send(bot, -100) for _ in range(3))
+            )
+            elapsed = time.monotonic() - started
+            total = chats * messages + 11
+            print(f"Лимиты: {total} сообщений за {elapsed:.1f} с ({total / elapsed:.1f}/с), 429: {request.rejected}")
+            if request.rejected:
+                problems.append(f"Заглушка ответила 429 на {request.rejected} сообщений")
+            if sum(map(len, request.delivered.values())) != total:
+                problems.append("Доставлены не все сообщения")
+
+            # Полосы: очередь рассылки, а поверх нее ответы пользователям
+            await asyncio.sleep(1)
+            bulk_chats = range(10001, 10001 + 5 * FAKE_GLOBAL_LIMIT[0])
+            bulk = [asyncio.ensure_future(send(bot, chat_id, SEND_BULK)) for chat_id in bulk_chats]
+            await asyncio.sleep(0.5)
+            submitted = time.monotonic()
+            interactive = await asyncio.gather(*(send(bot, chat_id) for chat_id in range(20001, 20021)))
+            bulk = await asyncio.gather(*bulk)
+            waited = max(interactive) - submitted
+            print(f"Полосы: 20 ответов за {waited:.2f} с поверх {len(bulk)} рассылок, "
+                  f"рассылка закончилась через {max(bulk) - submitted:.2f} с")
+            if max(interactive) > max(bulk) or waited > 2:
+                problems.append(f"Ответы ждали {waited:.2f} с за очередью рассылки")
+
+            # RetryAfter: чат блокируется на retry_after, и запрос повторяется
+            request.flood(30001, 1)
+            started = time.monotonic()
+            await send(bot, 30001)
+            elapsed = time.monotonic() - started
+            print(f"RetryAfter 1 с: доставлено через {elapsed:.2f} с")
+            if request.injected != 1 or elapsed < 1 or len(request.delivered[30001]) != 1:
+                problems.append(f"После RetryAfter: доставок {len(request.delivered[30001])}, ждали {elapsed:.2f} с")
+            if request.rejected:
+                problems.append(f"Заглушка ответила 429 на {request.rejected} сообщений")
+
+    with temp_db(10) as path:
+        asyncio.run(unlimited(path))
+        asyncio.run(throttled(path))
+    return report(problems, "Планировщик укладывается в лимиты, полосы и RetryAfter работают")
+
+
+def check_webhook_command(users='50', searches='5'):
+    """python bench.py check-webhook [USERS] [ПОИСКОВ]: WebhookServer и порядок обновлений без сети.
+
+    Запускает WebhookServer на приложении с заглушкой Bot API на
+    локальном порту и проверяет ответы: 403 без секретного токена и с
+    чужим (такие обновления не обрабатываются), 404 на чужой путь, 405 на
+    GET, 400 на битый JSON. Затем USERS новых пользователей параллельно
+    шлют по своему соединению создание анкеты и ПОИСКОВ нажатий «🔍 Найти
+    анкету»; каждое обновление перед обработкой ждет случайные доли
+    миллисекунд. Проверяет, что обновления каждого пользователя обработаны
+    PerUserUpdateProcessor в порядке отправки и что анкеты созданы.
+    """
+    users, searches = int(users), int(searches)
+    secret = 'check-secret'
+    logging.getLogger().setLevel(logging.WARNING)
+    problems = []
+
+    def post(conn, path, data=None, token=secret, method='POST'):
+        """Код ответа сервера на один запрос по keep-alive соединению"""
+        body = data if isinstance(data, bytes) else json.dumps(data).encode() if data else b''
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = token
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+
+    def send(port, stream):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        try:
+            return [post(conn, WEBHOOK_PATH, data) for data in stream]
+        finally:
+            conn.close()
+
+    async def check(path, size):
+        async with stub_bot(path) as (bot, request, client):
+            application = client.application
+            handled = collections.defaultdict(list)
+
+            async def jitter(update, context):
+                await asyncio.sleep(random.random() * 0.005)
+
+            async def record(update, context):
+                handled[update.effective_user.id].append(update.update_id)
+
+            # Группа -1 идет до обработчиков бота, группа 1 - после
+            application.add_handler(TypeHandler(Update, jitter), group=-1)
+            application.add_handler(TypeHandler(Update, record), group=1)
+            await application.start()
+            server = WebhookServer(application, path=WEBHOOK_PATH, secret_token=secret)
+            port = await server.start('127.0.0.1', 0)
+            loop = asyncio.get_running_loop()
+            try:
+                with ThreadPoolExecutor(max_workers=16) as pool:
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                    intruder = size + users + 1
+                    cases = (
+                        ('без секретного токена', 403, (WEBHOOK_PATH, client.text_update(intruder, '/start'), None)),
+                        ('с чужим токеном', 403, (WEBHOOK_PATH, client.text_update(intruder, '/start'), 'wrong')),
+                        ('на чужой путь', 404, ('/other', client.text_update(intruder, '/start'))),
+                        ('GET', 405, (WEBHOOK_PATH, None, secret, 'GET')),
+                        ('с битым JSON', 400, (WEBHOOK_PATH, b'{')),
+                    )
+                    for name, expected, args in cases:
+                        status = await loop.run_in_executor(pool, post, conn, *args)
+                        if status != expected:
+                            problems.append(f"Запрос {name}: ответ {status}, а не {expected}")
+                    conn.close()
+
+                    streams = {}
+                    for user_id in range(size + 1, size + users + 1):
+                        streams[user_id] = client.registration(user_id) + [
+                            client.text_update(user_id, "🔍 Найти анкету") for _ in range(searches)
+                        ]
+                    started = time.perf_counter()
+                    statuses = await asyncio.gather(
+                        *(loop.run_in_executor(pool, send, port, stream) for stream in streams.values())
+                    )
+                    await application.update_queue.join()
+                    elapsed = time.perf_counter() - started
+            finally:
+                await server.stop()
+                await application.stop()
+
+            total = sum(map(len, statuses))
+            print(f"{total} обновлений от {users} пользователей приняты и обработаны за {elapsed:.2f} с "
+                  f"({total / elapsed:.0f}/с)")
+            codes = collections.Counter(itertools.chain.from_iterable(statuses))
+            if set(codes) != {200}:
+                problems.append(f"Коды ответов на обновления: {dict(codes)}")
+            if intruder in handled:
+                problems.append("Обработано обновление, отклоненное по секретному токену")
+            for user_id, stream in streams.items():
+                sent = [data['update_id'] for data in stream]
+                if handled[user_id] != sent:
+                    problems.append(f"Пользователь {user_id}: обработаны {handled[user_id]}, отправлены {sent}")
+                elif not bot.profiles.profile_of(user_id):
+                    problems.append(f"Пользователь {user_id}: анкета не создана")
+
+    with temp_db(100) as path:
+        asyncio.run(check(path, 100))
+    return report(problems, "Webhook отвечает как надо, порядок обновлений каждого пользователя сохранен")
+
+
+def post_updates_command(url, count='100', users='10'):
+    """python bench.py post-updates URL [N] [USERS]: отправить на webhook N синтетических обновлений.
+
+    Обновления - нажатия "🔍 Найти анкету" от USERS пользователей; печатает
+    время и коды ответов. Секретный токен берется из WEBHOOK_SECRET.
+    """
+    count, users = int(count), int(users)
+    headers = {'Content-Type': 'application/json'}
+    if WEBHOOK_SECRET:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = WEBHOOK_SECRET
+
+    def post(update_id):
+        user_id = 1000 + update_id % users
+        body = json.dumps({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'Test{user_id}'},
+                'text': "🔍 Найти анкету"
+            }
+        }).encode()
+        request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        statuses = collections.Counter(pool.map(post, range(1, count + 1)))
+    elapsed = time.perf_counter() - started
+    print(f"Отправлено {count} обновлений за {elapsed:.2f} с ({count / elapsed:.0f}/с): {dict(statuses)}")
+    problems = [] if set(statuses) == {200} else [f"Коды ответов: {dict(statuses)}"]
+    return report(problems, "Все обновления приняты")
+
+
+if __name__ == "__main__":
+    commands = {
+        'bench': bench_command,
+        'bench-candidates': bench_candidates_command,
+        'bench-db': bench_db_command,
+        'bench-filters': bench_filters_command,
+        'bench-render': bench_render_command,
+        'bench-swipes': bench_swipes_command,
+        'check-workers': check_workers_command,
+        'check-backup': check_backup_command,
+        'check-latency': check_latency_command,
+        'check-plans': check_plans_command,
+        'check-send': check_send_command,
+        'check-snapshot': check_snapshot_command,
+        'check-webhook': check_webhook_command,
+        'post-updates': post_updates_command,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(f"Использование: python bench.py {{{'|'.join(commands)}}} [АРГУМЕНТЫ]")
+        sys.exit(2)
+    sys.exit(commands[sys.argv[1]](*sys.argv[2:]))
@@ -1,9 +1,33 @@
+import array
+import asyncio
+import base64
+import bisect
+import collections
+import csv
+import functools
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
 import logging
+import math
+import multiprocessing
 import sqlite3
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+import queue
+import random
+import re
+import shutil
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 
@@ -15,6 +39,52 @@ logging.basicConfig(
 
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 
+# Ключ подписи кнопок карточек; без SWIPE_SECRET выводится из токена, так что
+# у всех воркеров и после перезапуска он одинаковый
+SWIPE_SECRET = hashlib.sha256(('swipe:' + (os.environ.get('SWIPE_SECRET') or BOT_TOKEN or '')).encode()).digest()
+
+# Режим webhook включается, если задан публичный адрес WEBHOOK_URL
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', 8443)))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+# Метрики: порт Prometheus-эндпоинта (0 — выключен), адрес и период записи сводки в лог (с)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PATH = '/metrics'
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', 300))
+
+# Лимиты исходящих сообщений Telegram (сообщений в секунду) и запас на всплеск
+SEND_GLOBAL_RATE = 30
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 5
+SEND_GROUP_RATE = 20 / 60
+SEND_MAX_RETRIES = 3
+
+# Полосы приоритета исходящих: ответы пользователю идут раньше рассылок
+SEND_INTERACTIVE = 0
+SEND_BULK = 1
+
+# Сколько обновлений обрабатывается одновременно (для одного пользователя - по очереди)
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', 64))
+
+# Число процессов-воркеров: при WORKERS > 1 обновления делятся между ними по user_id
+WORKERS = int(os.environ.get('WORKERS', 1))
+# Упавший воркер перезапускается не чаще раза в столько секунд
+WORKER_RESTART_DELAY = 5.0
+# Пауза long polling после сетевой ошибки: от начальной, удваивается до предельной (с)
+POLL_RETRY_DELAY = 1.0
+POLL_RETRY_MAX_DELAY = 60.0
+
+# База данных: путь к файлу SQLite или URL вида схема://адрес (см. DATABASE_BACKENDS)
+DATABASE_URL = os.environ.get('DATABASE_URL', 'dating_bot.db')
+
+# Лента изменений анкет для других воркеров: период опроса и время хранения (с)
+PROFILE_SYNC_INTERVAL = 1.0
+PROFILE_CHANGES_TTL = 60 * 60
+
 # Список факультетов
 FACULTIES = {
     "ФН": "Фундаментальные науки",
@@ -32,96 +102,2612 @@ FACULTIES = {
     "ЮР": "Юриспруденция"
 }
 
-class DatingBot:
+
+def build_faculty_keyboard():
+    """Клавиатура выбора факультета"""
+    # Создаем 3 колонки для лучшего отображения
+    buttons = []
+    faculty_codes = list(FACULTIES.keys())
+    
+    # Разбиваем на строки по 3 элемента
+    for i in range(0, len(faculty_codes), 3):
+        row = []
+        for code in faculty_codes[i:i+3]:
+            row.append(InlineKeyboardButton(code, callback_data=f"faculty_{code}"))
+        buttons.append(row)
+    
+    return InlineKeyboardMarkup(buttons)
+
+
+# Клавиатуры не меняются и неизменяемы (объекты telegram заморожены),
+# поэтому строятся один раз и переиспользуются во всех ответах
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("👤 Создать анкету"), KeyboardButton("⚙️ Фильтры")],
+    [KeyboardButton("🔍 Найти анкету"), KeyboardButton("💝 Мои мэтчи")],
+    [KeyboardButton("📊 Моя анкета"), KeyboardButton("❌ Удалить анкету")]
+], resize_keyboard=True)
+
+# Тексты кнопок главного меню: нажатие отменяет ожидание ввода фильтра
+MAIN_MENU_TEXTS = frozenset(button.text for row in MAIN_MENU_KEYBOARD.keyboard for button in row)
+
+FACULTY_KEYBOARD = build_faculty_keyboard()
+
+GENDER_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("👨 Мужской", callback_data="gender_male"),
+        InlineKeyboardButton("👩 Женский", callback_data="gender_female")
+    ]
+])
+
+
+def swipe_signature(viewer_id, action, profile_id, owner_id):
+    """Подпись кнопки: 8 байт HMAC-SHA256 в base64url (11 символов)"""
+    message = f'{viewer_id}:{action}:{profile_id}:{owner_id}'.encode()
+    digest = hmac.new(SWIPE_SECRET, message, hashlib.sha256).digest()[:8]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def swipe_data(viewer_id, action, profile_id, owner_id):
+    """callback_data вида like:<profile_id>:<owner_id>:<подпись>, не длиннее 64 байт"""
+    return f'{action}:{profile_id}:{owner_id}:{swipe_signature(viewer_id, action, profile_id, owner_id)}'
+
+
+def parse_swipe_data(viewer_id, data):
+    """(действие, profile_id, owner_id) из callback_data или None, если подпись не сходится"""
+    try:
+        action, profile_id, owner_id, signature = data.split(':')
+        profile_id, owner_id = int(profile_id), int(owner_id)
+    except ValueError:
+        return None
+    expected = swipe_signature(viewer_id, action, profile_id, owner_id)
+    if not hmac.compare_digest(signature, expected):
+        return None
+    return action, profile_id, owner_id
+
+
+def swipe_keyboard(viewer_id, card):
+    """Кнопки лайк/дизлайк карточки: анкета записана в самих кнопках.
+
+    Подпись привязана к зрителю, поэтому подделать или переслать кнопку
+    другому пользователю нельзя.
+    """
+    profile_id, owner_id = card['profile_id'], card['user_id']
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("❤️ Лайк", callback_data=swipe_data(viewer_id, 'like', profile_id, owner_id)),
+            InlineKeyboardButton("👎 Дизлайк", callback_data=swipe_data(viewer_id, 'dislike', profile_id, owner_id))
+        ]
+    ])
+
+DB_WORKERS = int(os.environ.get('DB_WORKERS', 4))
+
+# Настройки каждого соединения: WAL, чтобы читатели не ждали писателя
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+)
+
+
+# Миграции схемы: (версия, функция). Текущая версия хранится в PRAGMA user_version
+def _migration_base_tables(cursor):
+    """Исходные таблицы users, profiles, likes"""
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица анкет
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS profiles (
+            profile_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            photo_id TEXT,
+            gender TEXT,
+            faculty TEXT,
+            age INTEGER,
+            bio TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица лайков
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS likes (
+            like_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user_id INTEGER,
+            to_profile_id INTEGER,
+            is_like BOOLEAN,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _migration_profile_name(cursor):
+    """В старых базах у profiles нет колонки name: пересоздаем таблицу в нужном порядке колонок"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(profiles)')]
+    if 'name' in columns:
+        return
+    cursor.execute('ALTER TABLE profiles RENAME TO profiles_old')
+    _migration_base_tables(cursor)
+    cursor.execute('''
+        INSERT INTO profiles (profile_id, user_id, photo_id, gender, faculty, age, bio, is_active, created_at)
+        SELECT profile_id, user_id, photo_id, gender, faculty, age, bio, is_active, created_at
+        FROM profiles_old
+    ''')
+    cursor.execute('DROP TABLE profiles_old')
+
+
+def _migration_hot_path_indexes(cursor):
+    """Уникальность лайка на пару (кто, какую анкету) и индексы для горячих запросов"""
+    # Оставляем только последнюю оценку каждой пары
+    cursor.execute('''
+        DELETE FROM likes WHERE like_id NOT IN (
+            SELECT MAX(like_id) FROM likes GROUP BY from_user_id, to_profile_id
+        )
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_likes_from_profile')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_likes_from_profile
+        ON likes (from_user_id, to_profile_id)
+    ''')
+    # Кто лайкнул анкету - проверка взаимности и мэтчи
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_likes_to_profile
+        ON likes (to_profile_id, is_like, from_user_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_profiles_user
+        ON profiles (user_id, is_active)
+    ''')
+    # Только активные анкеты: точный выбор кандидата проходит по этому индексу
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_profiles_active
+        ON profiles (profile_id, user_id) WHERE is_active = TRUE
+    ''')
+
+
+def _migration_matches(cursor):
+    """Таблица мэтчей: по строке на каждую сторону пары, заполняется из истории лайков"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS matches (
+            user_id INTEGER,
+            match_user_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, match_user_id)
+        ) WITHOUT ROWID
+    ''')
+    backfill_matches(cursor)
+
+
+def _migration_user_states(cursor):
+    """Таблица состояний незавершенного создания анкеты"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT,
+            updated_at REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_states_updated ON user_states (updated_at)')
+
+
+def _migration_search_prefs(cursor):
+    """Фильтры поиска: пол, диапазон возраста, набор факультетов (коды через запятую)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS search_prefs (
+            user_id INTEGER PRIMARY KEY,
+            gender TEXT,
+            age_min INTEGER,
+            age_max INTEGER,
+            faculties TEXT
+        )
+    ''')
+
+
+def _migration_match_outbox(cursor):
+    """Очередь уведомлений о мэтчах: пишется вместе с мэтчем, разбирается фоновой задачей"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS match_outbox (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            match_user_id INTEGER NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            UNIQUE (user_id, match_user_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON match_outbox(next_attempt_at)
+    ''')
+
+
+def _migration_profile_changes(cursor):
+    """Лента изменений анкет и username: по ней воркеры обновляют свои снимки в памяти"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS profile_changes (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            profile_id INTEGER,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+
+def _migration_photos(cursor):
+    """Метаданные загруженных фото: по file_unique_id ловятся повторные загрузки"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS photos (
+            file_unique_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            file_size INTEGER,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+
+def _migration_likes_archive(cursor):
+    """Архив старых дизлайков (упакованные profile_id по пользователю) и отметки обслуживания"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS likes_archive (
+            user_id INTEGER PRIMARY KEY,
+            profile_ids BLOB NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+
+
+SCHEMA_MIGRATIONS = [
+    (1, _migration_base_tables),
+    (2, _migration_profile_name),
+    (3, _migration_hot_path_indexes),
+    (4, _migration_matches),
+    (5, _migration_user_states),
+    (6, _migration_search_prefs),
+    (7, _migration_match_outbox),
+    (8, _migration_profile_changes),
+    (9, _migration_photos),
+    (10, _migration_likes_archive),
+]
+
+
+def migrate(conn):
+    """Применить недостающие миграции, каждую в своей транзакции. Вернуть версию схемы"""
+    (version,) = conn.execute('PRAGMA user_version').fetchone()
+    if version == 0 and not conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone():
+        # Новая база сразу в режиме, где место освобождает incremental_vacuum
+        # (VACUUM пустой базы мгновенный, без него режим не применится)
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    for target, migration in SCHEMA_MIGRATIONS:
+        if target <= version:
+            continue
+        conn.execute('BEGIN')
+        try:
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info(f"Миграция схемы {target}: {migration.__doc__}")
+        version = target
+    return version
+
+
+PHOTO_INSERT_SQL = '''
+    INSERT OR IGNORE INTO photos (file_unique_id, file_id, user_id, width, height, file_size, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+PHOTO_OWNER_SQL = 'SELECT user_id FROM photos WHERE file_unique_id = ?'
+
+INSERT_PROFILE_SQL = '''
+    INSERT INTO profiles (user_id, name, photo_id, gender, faculty, age, bio)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+SNAPSHOT_PROFILES_SQL = '''
+    SELECT profile_id, user_id, name, photo_id, gender, faculty, age, bio, created_at
+    FROM profiles WHERE is_active = TRUE ORDER BY profile_id
+'''
+
+INBOUND_LIKES_SQL = '''
+    SELECT to_profile_id, from_user_id FROM likes
+    WHERE to_profile_id IN ({}) AND is_like = TRUE
+'''
+
+SNAPSHOT_USERNAMES_SQL = 'SELECT user_id, username FROM users WHERE username IS NOT NULL'
+
+# Оцененные анкеты: строки likes (profile_id, NULL) и архив (NULL, упакованные id)
+# одним запросом, чтобы перенос в архив не попал между чтениями
+SEEN_BY_USER_SQL = '''
+    SELECT to_profile_id, NULL FROM likes WHERE from_user_id = ?
+    UNION ALL
+    SELECT NULL, profile_ids FROM likes_archive WHERE user_id = ?
+'''
+
+LIKE_UPSERT_SQL = '''
+    INSERT OR REPLACE INTO likes (from_user_id, to_profile_id, is_like)
+    VALUES (?, ?, ?)
+'''
+
+PROFILE_OWNER_SQL = 'SELECT user_id FROM profiles WHERE profile_id = ?'
+
+# Лайкал ли пользователь (первый ?) любую анкету пользователя (второй ?)
+# (поиск по idx_likes_to_profile по всем трем колонкам, а не перебор всех лайков пользователя)
+MUTUAL_LIKE_SQL = '''
+    SELECT 1 FROM likes
+    WHERE from_user_id = ? AND is_like = TRUE
+      AND to_profile_id IN (SELECT profile_id FROM profiles WHERE user_id = ?)
+    LIMIT 1
+'''
+
+MATCH_INSERT_SQL = '''
+    INSERT OR IGNORE INTO matches (user_id, match_user_id)
+    VALUES (?, ?), (?, ?)
+'''
+
+OUTBOX_INSERT_SQL = '''
+    INSERT OR IGNORE INTO match_outbox (user_id, match_user_id, next_attempt_at)
+    VALUES (?, ?, ?)
+'''
+
+OUTBOX_DUE_SQL = '''
+    SELECT event_id, user_id, match_user_id, attempts FROM match_outbox
+    WHERE next_attempt_at <= ? AND user_id % ? = ? ORDER BY next_attempt_at LIMIT ?
+'''
+
+PROFILE_CHANGE_SQL = '''
+    INSERT INTO profile_changes (kind, profile_id, user_id, created_at) VALUES (?, ?, ?, ?)
+'''
+
+PROFILE_CHANGES_SQL = '''
+    SELECT change_id, kind, profile_id, user_id FROM profile_changes
+    WHERE change_id > ? ORDER BY change_id
+'''
+
+MATCH_DELETE_SQL = '''
+    DELETE FROM matches
+    WHERE (user_id = ? AND match_user_id = ?) OR (user_id = ? AND match_user_id = ?)
+'''
+
+MATCHES_SQL = '''
+    SELECT p.name, u.username, p.faculty, p.bio, m.match_user_id
+    FROM matches m
+    JOIN profiles p ON p.user_id = m.match_user_id AND p.is_active = TRUE
+    LEFT JOIN users u ON u.user_id = m.match_user_id
+    WHERE m.user_id = ?
+'''
+
+# Страницы мэтчей по ключу match_user_id: вперед — после ключа, назад — до него
+MATCHES_NEXT_SQL = MATCHES_SQL + 'AND m.match_user_id > ? ORDER BY m.match_user_id LIMIT ?'
+MATCHES_PREV_SQL = MATCHES_SQL + 'AND m.match_user_id < ? ORDER BY m.match_user_id DESC LIMIT ?'
+
+def record_like(cursor, user_id, profile_id, is_like, notify_swiper=False):
+    """Сохранить оценку и обновить мэтчи в той же транзакции.
+
+    Возвращает True, если лайк взаимный: владелец анкеты уже лайкнул
+    какую-либо анкету этого пользователя. notify_swiper - свайпнувшему
+    ответили, что лайк не взаимный, и о новом мэтче он узнает из уведомления.
+    """
+    cursor.execute(LIKE_UPSERT_SQL, (user_id, profile_id, is_like))
+    owner = cursor.execute(PROFILE_OWNER_SQL, (profile_id,)).fetchone()
+    if not owner:
+        return False
+    (owner_id,) = owner
+    if not is_like:
+        cursor.execute(MATCH_DELETE_SQL, (user_id, owner_id, owner_id, user_id))
+        return False
+    if not cursor.execute(MUTUAL_LIKE_SQL, (owner_id, user_id)).fetchone():
+        return False
+    if cursor.execute(MATCH_INSERT_SQL, (user_id, owner_id, owner_id, user_id)).rowcount:
+        # Новый мэтч: свайпнувший узнает сразу, владельцу анкеты придет уведомление
+        cursor.execute(OUTBOX_INSERT_SQL, (owner_id, user_id, time.time()))
+        if notify_swiper:
+            cursor.execute(OUTBOX_INSERT_SQL, (user_id, owner_id, time.time()))
+    return True
+
+
+def record_likes(cursor, events):
+    """Записать пачку оценок (user_id, profile_id, is_like, ответили ли «взаимный») одной транзакцией"""
+    for user_id, profile_id, is_like, mutual in events:
+        record_like(cursor, user_id, profile_id, is_like, notify_swiper=is_like and not mutual)
+    return len(events)
+
+
+def backfill_matches(cursor):
+    """Пересобрать таблицу matches из истории лайков, вернуть число пар"""
+    cursor.execute('DELETE FROM matches')
+    # Встречный лайк ищется так же, как в MUTUAL_LIKE_SQL: по idx_likes_to_profile
+    cursor.execute('''
+        INSERT OR IGNORE INTO matches (user_id, match_user_id)
+        SELECT DISTINCT l.from_user_id, p.user_id
+        FROM likes l
+        JOIN profiles p ON p.profile_id = l.to_profile_id
+        WHERE l.is_like = TRUE AND EXISTS (
+            SELECT 1 FROM likes
+            WHERE from_user_id = p.user_id AND is_like = TRUE
+              AND to_profile_id IN (SELECT profile_id FROM profiles WHERE user_id = l.from_user_id)
+        )
+    ''')
+    (count,) = cursor.execute('SELECT COUNT(*) FROM matches').fetchone()
+    return count // 2
+
+
+def pack_profile_ids(profile_ids):
+    """Отсортированные profile_id в BLOB: 4 байта на id, little-endian"""
+    packed = array.array('I', sorted(profile_ids))
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_profile_ids(blob):
+    packed = array.array('I')
+    packed.frombytes(blob)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed
+
+
+def archive_dislikes(cursor, cutoff, limit):
+    """Перенести дизлайки старше cutoff в likes_archive.
+
+    Просматривает до limit строк likes после отметки likes_archived_id
+    (like_id растет вместе с created_at, поэтому просмотр останавливается
+    на первой свежей строке). Возвращает (просмотрено старых строк, перенесено).
+    """
+    row = cursor.execute(
+        "SELECT value FROM maintenance_state WHERE name = 'likes_archived_id'"
+    ).fetchone()
+    mark = row[0] if row else 0
+    rows = cursor.execute(
+        'SELECT like_id, from_user_id, to_profile_id, is_like, created_at FROM likes '
+        'WHERE like_id > ? ORDER BY like_id LIMIT ?', (mark, limit)
+    ).fetchall()
+    old = list(itertools.takewhile(lambda row: (row[4] or '') < cutoff, rows))
+    if not old:
+        return 0, 0
+
+    dislikes = collections.defaultdict(list)
+    for like_id, user_id, profile_id, is_like, _ in old:
+        if not is_like:
+            dislikes[user_id].append(profile_id)
+    for user_id, profile_ids in dislikes.items():
+        archived = cursor.execute(
+            'SELECT profile_ids FROM likes_archive WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if archived:
+            profile_ids.extend(unpack_profile_ids(archived[0]))
+        cursor.execute(
+            'INSERT OR REPLACE INTO likes_archive (user_id, profile_ids) VALUES (?, ?)',
+            (user_id, pack_profile_ids(set(profile_ids)))
+        )
+    cursor.executemany(
+        'DELETE FROM likes WHERE like_id = ?',
+        ((like_id,) for like_id, _, _, is_like, _ in old if not is_like)
+    )
+    cursor.execute(
+        "INSERT OR REPLACE INTO maintenance_state (name, value) VALUES ('likes_archived_id', ?)",
+        (old[-1][0],)
+    )
+    return len(old), sum(map(len, dislikes.values()))
+
+
+def prune_inactive_likes(cursor):
+    """Удалить оценки отключенных анкет (их больше никто не увидит), вернуть число строк.
+
+    Отключенные анкеты берутся из ленты profile_changes после отметки
+    likes_pruned_change_id. Все отключенные анкеты перебираются только в
+    первый раз и если часть ленты после отметки уже удалена по
+    PROFILE_CHANGES_TTL.
+    """
+    row = cursor.execute(
+        "SELECT value FROM maintenance_state WHERE name = 'likes_pruned_change_id'"
+    ).fetchone()
+    (low,) = cursor.execute('SELECT MIN(change_id) FROM profile_changes').fetchone()
+    top = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'profile_changes'").fetchone()
+    top = top[0] if top else 0
+    if row is None or (low or top + 1) > row[0] + 1:
+        inactive = cursor.execute('SELECT profile_id FROM profiles WHERE is_active = FALSE').fetchall()
+    else:
+        inactive = cursor.execute(
+            "SELECT profile_id FROM profile_changes WHERE change_id > ? AND kind = 'delete'", (row[0],)
+        ).fetchall()
+    pruned = 0
+    for (profile_id,) in inactive:
+        pruned += cursor.execute('DELETE FROM likes WHERE to_profile_id = ?', (profile_id,)).rowcount
+    cursor.execute(
+        "INSERT OR REPLACE INTO maintenance_state (name, value) VALUES ('likes_pruned_change_id', ?)",
+        (top,)
+    )
+    return pruned
+
+
+def incremental_vacuum(cursor, pages):
+    """Вернуть файлу до pages свободных страниц, если база в режиме auto_vacuum = INCREMENTAL"""
+    (mode,) = cursor.execute('PRAGMA auto_vacuum').fetchone()
+    if mode != 2:
+        return 0
+    (before,) = cursor.execute('PRAGMA freelist_count').fetchone()
+    # execute() делает один шаг прагмы (одну страницу), executescript — все
+    cursor.executescript(f'PRAGMA incremental_vacuum({pages})')
+    (after,) = cursor.execute('PRAGMA freelist_count').fetchone()
+    return before - after
+
+
+# Запросы горячего пути: ни один не должен читать таблицу сканированием (даже
+# по индексу). У запросов на одну строку указан ключ: таблица (или псевдоним
+# в запросе) -> колонки, которые поиск по индексу должен связать через «=»
+HOT_QUERIES = {
+    'seen_by_user': (SEEN_BY_USER_SQL, (0, 0), None),
+    'like_upsert': (LIKE_UPSERT_SQL, (0, 0, True), None),
+    'profile_owner': (PROFILE_OWNER_SQL, (0,), {'profiles': ('rowid',)}),
+    'photo_owner': (PHOTO_OWNER_SQL, ('',), {'photos': ('file_unique_id',)}),
+    'outbox_due': (OUTBOX_DUE_SQL, (0, 1, 0, 1), None),
+    'profile_changes': (PROFILE_CHANGES_SQL, (0,), None),
+    'matches_next': (MATCHES_NEXT_SQL, (0, 0, 1), None),
+    'matches_prev': (MATCHES_PREV_SQL, (0, 0, 1), None),
+    'inbound_likes': (INBOUND_LIKES_SQL.format('?'), (0,), None),
+    'mutual_like': (MUTUAL_LIKE_SQL, (0, 0), {'likes': ('from_user_id', 'to_profile_id')}),
+    'match_delete': (MATCH_DELETE_SQL, (0, 0, 0, 0), {'matches': ('user_id', 'match_user_id')}),
+    'matches': (MATCHES_SQL, (0,), None),
+}
+
+PLAN_SEARCH_RE = re.compile(r'SEARCH (\S+) USING .*\((.*)\)')
+
+
+def check_query_plans(conn):
+    """Горячие запросы с плохим планом: список (имя, строка плана)"""
+    slow = []
+    for name, (sql, params, key) in HOT_QUERIES.items():
+        plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        bad = [detail for detail in plan if detail.startswith('SCAN')]
+        for table, columns in (key or {}).items():
+            searches = [match for match in map(PLAN_SEARCH_RE.match, plan) if match and match[1] == table]
+            if not searches:
+                bad.append(f"{table}: нет поиска по индексу по {', '.join(columns)}")
+            for match in searches:
+                bound = {term[:-2] for term in match[2].split(' AND ') if term.endswith('=?')}
+                if not bound.issuperset(columns):
+                    bad.append(f"{match[0]}: нужен поиск по {', '.join(columns)}")
+        slow.extend((name, detail) for detail in bad)
+    return slow
+
+
+# Сколько промахов подряд допускаем до перехода на точный выбор
+CANDIDATE_PROBES = 8
+# Сколько позиций корзин точный выбор перебирает за шаг; между шагами
+# event loop обслуживает остальные обновления
+CANDIDATE_SCAN_BUDGET = 2000
+
+# Сколько памяти могут занимать множества просмотренных анкет (байт)
+SEEN_CACHE_BYTES = int(os.environ.get('SEEN_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Сколько готовых подписей анкет держать в памяти
+CAPTION_CACHE_SIZE = 50000
+
+# Очередь анкет на пользователя: размер пачки и порог фоновой дозагрузки
+CANDIDATE_BATCH = 50
+CANDIDATE_LOW_WATER = 10
+# Для скольких пользователей держать очереди в памяти (давно не заходившие вытесняются)
+CANDIDATE_QUEUE_USERS = 10000
+
+# Ранжирование выдачи: период пересчета (с), вес своего факультета, масштаб
+# разницы в возрасте (лет), минимальный вес корзины и степень смещения к новым
+# анкетам (1 — без смещения, меньше — сильнее)
+RANK_INTERVAL = 300
+RANK_FACULTY_WEIGHT = 2.0
+RANK_AGE_SCALE = 3.0
+RANK_MIN_WEIGHT = 0.1
+RANK_RECENCY = 0.5
+# Сколько анкет, уже лайкнувших пользователя, держать в плане и запрашивать за раз
+RANK_INBOUND_LIMIT = 200
+RANK_BATCH = 500
+
+# Состояния создания анкеты: размер кэша в памяти, время жизни (с) и период записи (с)
+STATE_CACHE_SIZE = 10000
+STATE_TTL = 24 * 60 * 60
+STATE_FLUSH_INTERVAL = 1.0
+
+# Уведомления о мэтчах: период разбора очереди (с), размер пачки, число попыток
+# и базовая задержка повтора (с), которая удваивается с каждой неудачей
+OUTBOX_INTERVAL = 2.0
+OUTBOX_BATCH = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 30.0
+
+# Мэтчи постранично: анкет на странице (5 описаний по 500 символов укладываются
+# в лимит сообщения 4096), время жизни (с) и число страниц в кэше
+MATCHES_PAGE_SIZE = 5
+MATCHES_PAGE_TTL = 30.0
+MATCHES_PAGE_CACHE_SIZE = 10000
+
+# Для карточки берется самый крупный размер фото, у которого длинная сторона
+# не больше этого (Telegram присылает до 2560 px, карточке хватает 1280)
+PHOTO_MAX_SIDE = 1280
+
+# Уплотнение истории оценок: период задачи (с), возраст дизлайков, которые
+# уходят в архив (дни), строк likes за одну транзакцию и страниц, которые
+# incremental_vacuum возвращает за проход
+LIKES_COMPACT_INTERVAL = 3600
+LIKES_ARCHIVE_DAYS = 30
+LIKES_COMPACT_BATCH = 5000
+LIKES_VACUUM_PAGES = 2000
+
+# Резервные копии: каталог, период задачи (с, 0 — выключена), сколько копий
+# хранить, страниц за шаг backup API и пауза между шагами (с)
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = float(os.environ.get('BACKUP_INTERVAL', 6 * 3600))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+BACKUP_PAGES = 256
+BACKUP_PAUSE = 0.005
+
+# Выгрузка статистики: каталог, сколько like_id читать за один запрос и шаг
+# возрастных групп (лет)
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+EXPORT_CHUNK = 50000
+# Пауза между запросами выгрузки (с): в окне без читателей писатель может
+# начать WAL с начала, иначе файл WAL растет все время выгрузки
+EXPORT_PAUSE = 0.05
+EXPORT_AGE_STEP = 3
+
+# Буфер оценок: сброс в БД пачкой по размеру или по времени (секунды)
+SWIPE_FLUSH_SIZE = 200
+SWIPE_FLUSH_INTERVAL = 0.5
+
+# Повторное нажатие на ту же карточку в течение окна (с) не учитывается;
+# сколько последних нажатий помнить
+SWIPE_DEDUP_WINDOW = 60.0
+SWIPE_DEDUP_SIZE = 100000
+
+def profile_caption(name, gender, faculty, age, bio):
+    """Подпись к карточке анкеты при поиске"""
+    gender_emoji = "👨" if gender == "male" else "👩"
+    display_name = name or "Пользователь"
+    return (
+        f"{gender_emoji} {display_name}\n"
+        f"🎓 Факультет: {faculty}\n"
+        f"📅 Возраст: {age}\n"
+        f"📝 О себе: {bio}"
+    )
+
+
+def own_profile_caption(name, gender, faculty, age, bio):
+    """Подпись к собственной анкете пользователя"""
+    gender_text = "Мужской" if gender == "male" else "Женский"
+    return (
+        f"👤 Ваша анкета:\n\n"
+        f"📛 Имя: {name}\n"
+        f"🎓 Факультет: {faculty}\n"
+        f"👫 Пол: {gender_text}\n"
+        f"📅 Возраст: {age}\n"
+        f"📝 О себе: {bio}"
+    )
+
+
+class CaptionCache:
+    """Готовые подписи анкет по (вид подписи, profile_id, версия анкеты).
+
+    invalidate() повышает версию анкеты, так что подпись, которую в этот
+    момент дорисовывает поток БД, уже не будет выдана. Используется и из
+    потоков БД, и из event loop, поэтому защищен блокировкой.
+    """
+
+    def __init__(self, max_size=CAPTION_CACHE_SIZE):
+        self.max_size = max_size
+        self.captions = collections.OrderedDict()
+        self.versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, profile_id, render, *fields):
+        """Подпись из кэша или render(*fields)"""
+        with self._lock:
+            key = (kind, profile_id, self.versions.get(profile_id, 0))
+            caption = self.captions.get(key)
+            if caption is not None:
+                self.captions.move_to_end(key)
+                return caption
+        caption = render(*fields)
+        with self._lock:
+            self.captions[key] = caption
+            while len(self.captions) > self.max_size:
+                self.captions.popitem(last=False)
+        return caption
+
+    def invalidate(self, profile_id):
+        """Анкета изменилась или удалена"""
+        with self._lock:
+            version = self.versions.get(profile_id, 0)
+            self.versions[profile_id] = version + 1
+            for kind in ('card', 'own'):
+                self.captions.pop((kind, profile_id, version), None)
+
+
+def pick_photo(sizes):
+    """Размер фото для карточки из message.photo (размеры идут по возрастанию)"""
+    fitting = [size for size in sizes if max(size.width, size.height) <= PHOTO_MAX_SIDE]
+    return fitting[-1] if fitting else sizes[0]
+
+
+def profile_card(record, username, captions=None):
+    """Готовая карточка из ProfileRecord: все, что нужно для отправки анкеты"""
+    fields = (record.name, record.gender, record.faculty, record.age, record.bio)
+    return {
+        'profile_id': record.profile_id,
+        'user_id': record.user_id,
+        'username': username,
+        'photo_id': record.photo_id,
+        'caption': (
+            captions.get('card', record.profile_id, profile_caption, *fields)
+            if captions else profile_caption(*fields)
+        )
+    }
+
+
+def prefs_match(prefs, gender, faculty, age):
+    """Подходит ли анкета под фильтры поиска"""
+    if prefs.get('gender') and gender != prefs['gender']:
+        return False
+    if prefs.get('age_min') is not None and (age is None or age < prefs['age_min']):
+        return False
+    if prefs.get('age_max') is not None and (age is None or age > prefs['age_max']):
+        return False
+    faculties = prefs.get('faculties')
+    if faculties and FACULTIES.get(faculty, faculty) not in {FACULTIES[code] for code in faculties}:
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=65536)
+def bucket_affinity(own_faculty, own_age, faculty, age):
+    """Вес корзины (факультет, возраст) для пользователя: свой факультет и близкий возраст выше"""
+    weight = 1.0 + (RANK_FACULTY_WEIGHT if faculty == own_faculty else 0.0)
+    if own_age is not None and age is not None:
+        weight *= RANK_MIN_WEIGHT + math.exp(-abs(age - own_age) / RANK_AGE_SCALE)
+    return weight
+
+
+class DiscoveryIndex:
+    """Активные анкеты в памяти по корзинам (пол, факультет, возраст)"""
+
+    def __init__(self):
+        # ключ корзины -> [profile_id, ...] в порядке создания (в конце новые);
+        # удаленная анкета оставляет None, пока корзина не уплотнится
+        self.buckets = {}
+        # ключ корзины -> число живых анкет в ней
+        self.live = {}
+        # ключ корзины -> поколение: меняется, когда позиции в корзине сдвигаются
+        self.generations = {}
+        self._generation = itertools.count()
+        # profile_id -> [ключ корзины, позиция в корзине, user_id владельца]
+        self.entries = {}
+
+    def on_change(self, kind, record):
+        """Подписчик ленты изменений ProfileSnapshot"""
+        if kind == 'insert':
+            self.add(record.profile_id, record.user_id, record.gender, record.faculty, record.age)
+        else:
+            self.remove(record.profile_id)
+
+    def add(self, profile_id, user_id, gender, faculty, age):
+        if profile_id in self.entries:
+            return
+        key = (gender, faculty, age)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = []
+            self.generations[key] = next(self._generation)
+        self.entries[profile_id] = [key, len(bucket), user_id]
+        bucket.append(profile_id)
+        self.live[key] = self.live.get(key, 0) + 1
+
+    def remove(self, profile_id):
+        entry = self.entries.pop(profile_id, None)
+        if entry is None:
+            return
+        key, position, _ = entry
+        bucket = self.buckets[key]
+        bucket[position] = None
+        self.live[key] -= 1
+        if not self.live[key]:
+            del self.buckets[key]
+            del self.live[key]
+            del self.generations[key]
+        elif self.live[key] * 2 < len(bucket):
+            self._compact(key)
+
+    def _compact(self, key):
+        """Убрать None из корзины, сохранив порядок анкет"""
+        bucket = self.buckets[key]
+        bucket[:] = [profile_id for profile_id in bucket if profile_id is not None]
+        for position, profile_id in enumerate(bucket):
+            self.entries[profile_id][1] = position
+        self.generations[key] = next(self._generation)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sample(self, prefs, user_id, limit, exclude=(), seen=(), weight=None):
+        """До limit случайных подходящих непросмотренных анкет (остаток добирает scan)"""
+        buckets = []
+        weights = []
+        for key, bucket in self.buckets.items():
+            if prefs_match(prefs, *key):
+                buckets.append(bucket)
+                weights.append(self.live[key] * weight(key) if weight else self.live[key])
+        offsets = list(itertools.accumulate(weights))
+        total = offsets[-1] if offsets else 0
+        if not total:
+            return []
+
+        def usable(profile_id):
+            return (profile_id is not None and profile_id not in found and profile_id not in exclude
+                    and profile_id not in seen and self.entries[profile_id][2] != user_id)
+
+        found = []
+        misses = 0
+        while len(found) < limit and misses < CANDIDATE_PROBES:
+            b = min(bisect.bisect_right(offsets, random.random() * total), len(buckets) - 1)
+            bucket = buckets[b]
+            # weight(ключ корзины) - вес корзины, внутри нее выбор смещен к новым анкетам
+            if weight:
+                position = int(len(bucket) * random.random() ** RANK_RECENCY)
+            else:
+                position = random.randrange(len(bucket))
+            profile_id = bucket[position]
+            if usable(profile_id):
+                found.append(profile_id)
+                misses = 0
+            else:
+                misses += 1
+        return found
+
+    def scan(self, prefs, user_id, limit, cursor, exclude=(), seen=(), budget=CANDIDATE_SCAN_BUDGET):
+        """Точный выбор по порядку корзин не дальше budget позиций: (найденные, пройдено ли все)"""
+        # cursor пользователя: ключ корзины -> (поколение, позиция), так что
+        # проверенные позиции повторно не перебираются
+        found = []
+        for key, bucket in self.buckets.items():
+            if not prefs_match(prefs, *key):
+                continue
+            generation, position = cursor.get(key, (None, 0))
+            if generation != self.generations[key]:
+                position = 0
+            end = min(len(bucket), position + budget)
+            budget -= end - position
+            while position < end and len(found) < limit:
+                profile_id = bucket[position]
+                position += 1
+                if (profile_id is not None and profile_id not in exclude and profile_id not in seen
+                        and self.entries[profile_id][2] != user_id):
+                    found.append(profile_id)
+            cursor[key] = (self.generations[key], position)
+            if position < len(bucket) or len(found) >= limit:
+                return found, False
+        return found, True
+
+
+class ProfileRecord:
+    """Активная анкета в памяти"""
+
+    __slots__ = ('profile_id', 'user_id', 'name', 'photo_id', 'gender',
+                 'faculty', 'age', 'bio', 'created_at')
+
+    def __init__(self, profile_id, user_id, name, photo_id, gender, faculty, age, bio, created_at):
+        self.profile_id = profile_id
+        self.user_id = user_id
+        self.name = name
+        self.photo_id = photo_id
+        self.gender = gender
+        self.faculty = faculty
+        self.age = age
+        self.bio = bio
+        self.created_at = created_at
+
+    def row(self):
+        return (self.profile_id, self.user_id, self.name, self.photo_id, self.gender,
+                self.faculty, self.age, self.bio, self.created_at)
+
+
+class ProfileSnapshot:
+    """Модель чтения: все активные анкеты и username пользователей в памяти.
+
+    Загружается при старте, дальше поддерживается лентой изменений: каждая
+    запись в profiles (создание и удаление анкеты) вызывает insert/delete,
+    которые обновляют снимок и оповещают подписчиков (индекс поиска).
+    Обработчики чтения обходятся без SQL.
+    """
+
+    def __init__(self):
+        self.records = {}
+        # user_id -> [profile_id, ...]: в старых базах активных анкет у пользователя бывает несколько
+        self.by_user = {}
+        # Растет с каждой новой анкетой
+        self.version = 0
+        self.usernames = {}
+        self.subscribers = []
+
+    def subscribe(self, listener):
+        """listener(kind, record) вызывается на каждое изменение, kind: 'insert' или 'delete'"""
+        self.subscribers.append(listener)
+
+    async def load(self, db):
+        rows = await db.fetchall(SNAPSHOT_PROFILES_SQL)
+        usernames = await db.fetchall(SNAPSHOT_USERNAMES_SQL)
+        self.records.clear()
+        self.by_user.clear()
+        self.usernames = dict(usernames)
+        for row in rows:
+            self.insert(ProfileRecord(*row))
+        return len(rows)
+
+    def insert(self, record):
+        if record.profile_id in self.records:
+            return
+        # Пол и факультет повторяются у тысяч анкет: храним по одной копии строки
+        if record.gender:
+            record.gender = sys.intern(record.gender)
+        if record.faculty:
+            record.faculty = sys.intern(record.faculty)
+        self.records[record.profile_id] = record
+        self.by_user.setdefault(record.user_id, []).append(record.profile_id)
+        self.version += 1
+        for listener in self.subscribers:
+            listener('insert', record)
+
+    def delete(self, profile_id):
+        record = self.records.pop(profile_id, None)
+        if record is None:
+            return
+        profile_ids = self.by_user[record.user_id]
+        profile_ids.remove(profile_id)
+        if not profile_ids:
+            del self.by_user[record.user_id]
+        for listener in self.subscribers:
+            listener('delete', record)
+
+    def set_username(self, user_id, username):
+        if username:
+            self.usernames[user_id] = username
+        else:
+            self.usernames.pop(user_id, None)
+
+    def profile_of(self, user_id):
+        """Активная анкета пользователя или None"""
+        profile_ids = self.by_user.get(user_id)
+        return self.records[min(profile_ids)] if profile_ids else None
+
+    def cards(self, profile_ids, captions=None):
+        """Карточки анкет из снимка (удаленные пропускаются)"""
+        cards = []
+        for profile_id in profile_ids:
+            record = self.records.get(profile_id)
+            if record is None:
+                continue
+            cards.append(profile_card(record, self.usernames.get(record.user_id), captions))
+        return cards
+
+    def diff(self, cursor):
+        """Расхождения снимка с БД: список (profile_id, в снимке, в БД)"""
+        actual = {row[0]: tuple(row) for row in cursor.execute(SNAPSHOT_PROFILES_SQL)}
+        problems = []
+        for profile_id in self.records.keys() | actual.keys():
+            record = self.records.get(profile_id)
+            mine = record.row() if record else None
+            if mine != actual.get(profile_id):
+                problems.append((profile_id, mine, actual.get(profile_id)))
+        usernames = dict(cursor.execute(SNAPSHOT_USERNAMES_SQL))
+        for user_id in self.usernames.keys() | usernames.keys():
+            if self.usernames.get(user_id) != usernames.get(user_id):
+                problems.append((('username', user_id), self.usernames.get(user_id), usernames.get(user_id)))
+        return problems
+
+
+class Recommender:
+    """Выдача по ожидаемой взаимности: сначала лайкнувшие пользователя, затем корзины по весу"""
+
+    def __init__(self, db, snapshot, discovery, swipes=None):
+        self.db = db
+        self.snapshot = snapshot
+        self.discovery = discovery
+        self.swipes = swipes
+        # user_id -> (время расчета, [profile_id лайкнувших, новые первыми])
+        self.inbound = {}
+
+    async def refresh(self, user_ids):
+        """Пересчитать входящие лайки пачкой, вернуть число пользователей"""
+        owners = {}
+        for user_id in user_ids:
+            record = self.snapshot.profile_of(user_id)
+            if record:
+                owners[record.profile_id] = user_id
+        profile_ids = list(owners)
+        likers = {user_id: [] for user_id in owners.values()}
+        for start in range(0, len(profile_ids), RANK_BATCH):
+            chunk = profile_ids[start:start + RANK_BATCH]
+            rows = await self.db.fetchall(INBOUND_LIKES_SQL.format(','.join('?' * len(chunk))), chunk)
+            for to_profile_id, from_user_id in rows:
+                likers[owners[to_profile_id]].append(from_user_id)
+        if self.swipes:
+            # Свежие лайки могут быть еще в буфере
+            for user_id, from_users in self.swipes.likers(likers).items():
+                likers[user_id].extend(from_users)
+        now = time.monotonic()
+        for user_id, from_users in likers.items():
+            inbound = []
+            for from_user_id in set(from_users):
+                record = self.snapshot.profile_of(from_user_id)
+                if record:
+                    inbound.append(record.profile_id)
+            inbound.sort(reverse=True)
+            self.inbound[user_id] = (now, inbound[:RANK_INBOUND_LIMIT])
+        return len(likers)
+
+    def prune(self, before):
+        """Забыть входящие лайки, посчитанные раньше before (time.monotonic())"""
+        for user_id in [u for u, (computed, _) in self.inbound.items() if computed < before]:
+            del self.inbound[user_id]
+
+    async def sample(self, prefs, user_id, limit, exclude=(), seen=(), cursor=None):
+        """До limit анкет в порядке убывания ожидаемой взаимности (cursor - см. DiscoveryIndex.scan)"""
+        entry = self.inbound.get(user_id)
+        if entry is None or time.monotonic() - entry[0] > 2 * RANK_INTERVAL:
+            await self.refresh([user_id])
+            entry = self.inbound.get(user_id, (0, []))
+
+        found = []
+        for profile_id in entry[1]:
+            if len(found) >= limit:
+                break
+            index_entry = self.discovery.entries.get(profile_id)
+            if (index_entry and profile_id not in exclude and profile_id not in seen
+                    and prefs_match(prefs, *index_entry[0])):
+                found.append(profile_id)
+
+        record = self.snapshot.profile_of(user_id)
+        own_faculty, own_age = (record.faculty, record.age) if record else (None, None)
+        found.extend(self.discovery.sample(
+            prefs, user_id, limit - len(found), set(exclude) | set(found), seen,
+            weight=lambda key: bucket_affinity(own_faculty, own_age, key[1], key[2])
+        ))
+        # Непросмотренных под фильтром мало: добираем по порядку шагами,
+        # отдавая event loop другим обновлениям между шагами
+        cursor = {} if cursor is None else cursor
+        while len(found) < limit:
+            more, done = self.discovery.scan(
+                prefs, user_id, limit - len(found), cursor, set(exclude) | set(found), seen
+            )
+            found.extend(more)
+            if done:
+                break
+            await asyncio.sleep(0)
+        return found
+
+
+def load_changed(cursor, changes):
+    """Строки анкет и username, затронутые пачкой изменений profile_changes"""
+    profile_ids = [profile_id for _, kind, profile_id, _ in changes if kind == 'insert']
+    user_ids = [user_id for _, kind, _, user_id in changes if kind == 'username']
+    profiles = {}
+    for start in range(0, len(profile_ids), RANK_BATCH):
+        chunk = profile_ids[start:start + RANK_BATCH]
+        rows = cursor.execute(
+            SNAPSHOT_PROFILES_SQL.replace('ORDER BY', f"AND profile_id IN ({','.join('?' * len(chunk))}) ORDER BY"),
+            chunk
+        ).fetchall()
+        profiles.update((row[0], row) for row in rows)
+    usernames = {}
+    for start in range(0, len(user_ids), RANK_BATCH):
+        chunk = user_ids[start:start + RANK_BATCH]
+        usernames.update(cursor.execute(
+            f"SELECT user_id, username FROM users WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall())
+    return profiles, usernames
+
+
+class SearchPrefsStore:
+    """Фильтры поиска пользователей с кэшем в памяти"""
+
+    def __init__(self, db):
+        self.db = db
+        self.cache = {}
+
+    async def get(self, user_id):
+        """dict с ключами gender, age_min, age_max, faculties или None"""
+        if user_id not in self.cache:
+            row = await self.db.fetchone(
+                'SELECT gender, age_min, age_max, faculties FROM search_prefs WHERE user_id = ?',
+                (user_id,)
+            )
+            prefs = None
+            if row:
+                gender, age_min, age_max, faculties = row
+                prefs = {
+                    'gender': gender,
+                    'age_min': age_min,
+                    'age_max': age_max,
+                    'faculties': frozenset(faculties.split(',')) if faculties else frozenset()
+                }
+            self.cache[user_id] = prefs
+        return self.cache[user_id]
+
+    async def set(self, user_id, prefs):
+        """Сохранить фильтры; пустые фильтры удаляются"""
+        if prefs and not (prefs.get('gender') or prefs.get('faculties')
+                          or prefs.get('age_min') is not None or prefs.get('age_max') is not None):
+            prefs = None
+        self.cache[user_id] = prefs
+        if prefs is None:
+            await self.db.execute('DELETE FROM search_prefs WHERE user_id = ?', (user_id,))
+            return
+        await self.db.execute(
+            'INSERT OR REPLACE INTO search_prefs (user_id, gender, age_min, age_max, faculties) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (user_id, prefs.get('gender'), prefs.get('age_min'), prefs.get('age_max'),
+             ','.join(sorted(prefs.get('faculties') or ())) or None)
+        )
+
+
+class ProfileIdSet:
+    """Компактное множество profile_id в духе Roaring bitmap.
+
+    Старшие 16 бит id выбирают контейнер; пока в контейнере мало значений,
+    он хранится отсортированным array('H') (2 байта на id), а при
+    заполнении превращается в битовую карту на 8 КБ.
+    """
+
+    __slots__ = ('containers', 'count')
+
+    ARRAY_LIMIT = 4096
+    BITMAP_BYTES = 8192
+
+    def __init__(self, values=()):
+        self.containers = {}
+        self.count = 0
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        high, low = value >> 16, value & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            container = self.containers[high] = array.array('H')
+        if isinstance(container, bytearray):
+            mask = 1 << (low & 7)
+            if not container[low >> 3] & mask:
+                container[low >> 3] |= mask
+                self.count += 1
+            return
+        index = bisect.bisect_left(container, low)
+        if index < len(container) and container[index] == low:
+            return
+        container.insert(index, low)
+        self.count += 1
+        if len(container) > self.ARRAY_LIMIT:
+            bitmap = bytearray(self.BITMAP_BYTES)
+            for item in container:
+                bitmap[item >> 3] |= 1 << (item & 7)
+            self.containers[high] = bitmap
+
+    def __contains__(self, value):
+        container = self.containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(container, bytearray):
+            return bool(container[low >> 3] & (1 << (low & 7)))
+        index = bisect.bisect_left(container, low)
+        return index < len(container) and container[index] == low
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return sum(
+            len(c) if isinstance(c, bytearray) else len(c) * c.itemsize
+            for c in self.containers.values()
+        )
+
+
+class SeenIndex:
+    """Уже оцененные анкеты каждого пользователя в памяти.
+
+    Множество загружается из likes при первом обращении и дальше
+    обновляется на каждом свайпе. Когда общий объем превышает max_bytes,
+    давно не использованные множества выгружаются: таблица likes и есть их
+    копия на диске, при следующем обращении они загрузятся заново. Оценки,
+    которые еще ждут записи в swipes, добавляются к загруженному множеству.
+    """
+
+    def __init__(self, db, swipes=None, max_bytes=SEEN_CACHE_BYTES):
+        self.db = db
+        self.swipes = swipes
+        self.max_bytes = max_bytes
+        self.sets = collections.OrderedDict()
+        self.nbytes = 0
+        # user_id -> (задача загрузки, оценки, пришедшие во время загрузки)
+        self.loading = {}
+
+    async def get(self, user_id):
+        """ProfileIdSet оцененных пользователем анкет"""
+        seen = self.sets.get(user_id)
+        if seen is not None:
+            self.sets.move_to_end(user_id)
+            return seen
+        if user_id not in self.loading:
+            task = asyncio.create_task(self.db.fetchall(SEEN_BY_USER_SQL, (user_id, user_id)))
+            # Незаписанные оценки: запрос их не увидит, а буфер может успеть
+            # их записать и забыть, пока запрос идет
+            self.loading[user_id] = (task, list(self._pending(user_id)))
+        task, added = self.loading[user_id]
+        try:
+            rows = await task
+        finally:
+            self.loading.pop(user_id, None)
+        if user_id in self.sets:
+            return self.sets[user_id]
+        seen = ProfileIdSet()
+        for profile_id, archived in rows:
+            if archived is None:
+                seen.add(profile_id)
+            else:
+                for archived_id in unpack_profile_ids(archived):
+                    seen.add(archived_id)
+        for profile_id in itertools.chain(added, self._pending(user_id)):
+            seen.add(profile_id)
+        self.sets[user_id] = seen
+        self.nbytes += seen.nbytes
+        self._evict()
+        return seen
+
+    def _pending(self, user_id):
+        return self.swipes.rated_profiles(user_id) if self.swipes else ()
+
+    def add(self, user_id, profile_id):
+        """Пользователь оценил анкету"""
+        seen = self.sets.get(user_id)
+        if seen is not None:
+            before = seen.nbytes
+            seen.add(profile_id)
+            self.nbytes += seen.nbytes - before
+            self._evict()
+        elif user_id in self.loading:
+            self.loading[user_id][1].append(profile_id)
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self.sets) > 1:
+            _, seen = self.sets.popitem(last=False)
+            self.nbytes -= seen.nbytes
+
+
+class UserQueue:
+    """Очередь анкет одного пользователя"""
+
+    __slots__ = ('cards', 'last_shown', 'refill', 'cursor', 'exhausted', 'active')
+
+    def __init__(self):
+        self.cards = collections.deque()
+        # Когда пользователь последний раз листал анкеты (time.monotonic())
+        self.active = None
+        # Показанная, но еще не оцененная анкета
+        self.last_shown = None
+        # Задача фоновой дозагрузки
+        self.refill = None
+        # Позиции точного выбора в корзинах (DiscoveryIndex.scan)
+        self.cursor = {}
+        # Версия снимка, на которой подходящие анкеты кончились
+        self.exhausted = None
+
+
+class CandidateQueue:
+    """Предзагруженные очереди анкет с фоновой дозагрузкой, чтобы свайп обходился без запроса к БД"""
+
+    def __init__(self, snapshot, recommender, swipes=None, seen=None, captions=None, prefs=None,
+                 max_users=CANDIDATE_QUEUE_USERS):
+        self.captions = captions
+        self.prefs = prefs
+        self.snapshot = snapshot
+        self.recommender = recommender
+        self.swipes = swipes
+        self.seen = seen
+        self.max_users = max_users
+        # user_id -> UserQueue, давно не заходившие в начале; вытесненная очередь соберется заново
+        self.users = collections.OrderedDict()
+
+    def _user(self, user_id):
+        """Очередь пользователя (новая, если ее нет), отмеченная как свежая"""
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = UserQueue()
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+        entry.active = time.monotonic()
+        return entry
+
+    def active_users(self, since):
+        """Пользователи, листавшие анкеты после since (time.monotonic())"""
+        users = []
+        for user_id in reversed(self.users):
+            if self.users[user_id].active < since:
+                break
+            users.append(user_id)
+        return users
+
+    async def next(self, user_id):
+        """Следующая карточка для пользователя или None, если анкет не осталось"""
+        entry = self._user(user_id)
+        while True:
+            while entry.cards:
+                card = entry.cards.popleft()
+                if card['profile_id'] not in self.snapshot.records:
+                    continue
+                entry.last_shown = card['profile_id']
+                if len(entry.cards) < CANDIDATE_LOW_WATER:
+                    self._schedule_refill(user_id, entry)
+                return card
+            task = self._schedule_refill(user_id, entry)
+            if not await task:
+                return None
+
+    def _schedule_refill(self, user_id, entry):
+        """Запустить дозагрузку очереди, если она еще не идет"""
+        if entry.refill is None or entry.refill.done():
+            entry.refill = asyncio.create_task(self._refill(user_id, entry))
+        return entry.refill
+
+    async def _refill(self, user_id, entry):
+        """Догрузить пачку карточек, вернуть число добавленных"""
+        # Анкеты кончились, и с тех пор новых не появилось
+        if entry.exhausted == self.snapshot.version:
+            return 0
+        # Показанная, но еще не оцененная анкета тоже не должна вернуться
+        exclude = {card['profile_id'] for card in entry.cards}
+        if entry.last_shown is not None:
+            exclude.add(entry.last_shown)
+        # Оценки, еще не записанные в БД
+        if self.swipes:
+            exclude |= self.swipes.rated_profiles(user_id)
+        seen = await self.seen.get(user_id) if self.seen else ()
+        prefs = await self.prefs.get(user_id) if self.prefs else None
+        started = time.perf_counter()
+        # Анкеты ранжирует Recommender, карточки собираются из снимка без SQL
+        version = self.snapshot.version
+        profile_ids = await self.recommender.sample(
+            prefs or {}, user_id, CANDIDATE_BATCH, exclude, seen, entry.cursor
+        )
+        cards = self.snapshot.cards(profile_ids, self.captions)
+        METRICS.observe('candidate_refill_seconds', (), time.perf_counter() - started)
+        entry.cards.extend(cards)
+        if not cards:
+            entry.exhausted = version
+        return len(cards)
+
+    def reset(self, user_id):
+        """Сбросить очередь пользователя (например, после смены фильтров)"""
+        self.users.pop(user_id, None)
+
+    def deactivate(self, user_id, profile_ids):
+        """Анкеты пользователя удалены из снимка: сбросить его подписи и очередь"""
+        if self.captions:
+            for profile_id in profile_ids:
+                self.captions.invalidate(profile_id)
+        self.users.pop(user_id, None)
+
+
+class BackgroundFlusher:
+    """Фоновая задача, которая вызывает flush() раз в interval секунд или по wake()"""
+
+    interval = 1.0
+
+    def __init__(self):
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        """Запустить фоновый сброс (вызывается из работающего event loop)"""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    def wake(self):
+        """Сбросить данные, не дожидаясь таймера"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка фоновой записи {type(self).__name__}: {e}")
+
+    async def stop(self):
+        """Остановить фоновый сброс и записать остаток"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class SwipeDedup:
+    """Окно идемпотентности нажатий на карточки.
+
+    Запоминает (user_id, profile_id) на SWIPE_DEDUP_WINDOW секунд, так что
+    двойное нажатие или повторная доставка callback учитывается один раз.
+    Проверка и запись синхронны, поэтому одновременные обновления одного
+    пользователя не проскакивают между ними.
+    """
+
+    def __init__(self, window=SWIPE_DEDUP_WINDOW, max_size=SWIPE_DEDUP_SIZE):
+        self.window = window
+        self.max_size = max_size
+        # (user_id, profile_id) -> момент нажатия, в порядке нажатий
+        self.taps = collections.OrderedDict()
+
+    def first(self, user_id, profile_id):
+        """True для первого нажатия в окне, False для повтора"""
+        now = time.monotonic()
+        while self.taps:
+            key, tapped = next(iter(self.taps.items()))
+            if now - tapped < self.window and len(self.taps) < self.max_size:
+                break
+            self.taps.popitem(last=False)
+        key = (user_id, profile_id)
+        if key in self.taps:
+            return False
+        self.taps[key] = now
+        return True
+
+
+class SwipeBuffer(BackgroundFlusher):
+    """Отложенная запись лайков и дизлайков.
+
+    Оценки копятся в памяти и записываются одной транзакцией, когда их
+    набирается SWIPE_FLUSH_SIZE или проходит SWIPE_FLUSH_INTERVAL секунд.
+    Взаимность проверяется сразу: сначала по еще не записанным лайкам,
+    затем по БД. Мэтчи в таблицу matches попадают при записи пачки.
+    """
+
+    def __init__(self, db, max_size=SWIPE_FLUSH_SIZE, interval=SWIPE_FLUSH_INTERVAL):
+        super().__init__()
+        self.db = db
+        self.max_size = max_size
+        self.interval = interval
+        self.pending = []
+        # Незаписанные события: текущие и те, что пишутся прямо сейчас
+        self.views = [self._new_view()]
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _new_view():
+        return {'likes': set(), 'rated': collections.defaultdict(set)}
+
+    async def add(self, user_id, profile_id, owner_id, is_like):
+        """Принять оценку, вернуть True, если это взаимный лайк"""
+        self._remember(user_id, profile_id, owner_id, is_like)
+        mutual = False
+        if is_like:
+            mutual = any((owner_id, user_id) in v['likes'] for v in self.views) or bool(
+                await self.db.fetchone(MUTUAL_LIKE_SQL, (owner_id, user_id))
+            )
+            # Пока шел запрос, текущая пачка могла уйти на запись
+            self._remember(user_id, profile_id, owner_id, is_like)
+        # Ответ свайпнувшему пишется вместе с оценкой: если мэтч сложится только
+        # при записи (встречный лайк был в буфере другого воркера), ему придет уведомление
+        self.pending.append((user_id, profile_id, is_like, mutual))
+        if len(self.pending) >= self.max_size:
+            self.wake()
+        return mutual
+
+    def _remember(self, user_id, profile_id, owner_id, is_like):
+        view = self.views[-1]
+        view['rated'][user_id].add(profile_id)
+        if is_like:
+            view['likes'].add((user_id, owner_id))
+
+    def likers(self, owner_ids):
+        """owner_id -> [user_id] по еще не записанным в БД лайкам анкет этих владельцев"""
+        likers = collections.defaultdict(list)
+        for view in self.views:
+            for user_id, owner_id in view['likes']:
+                if owner_id in owner_ids:
+                    likers[owner_id].append(user_id)
+        return likers
+
+    def rated_profiles(self, user_id):
+        """profile_id, которые пользователь оценил, но которые еще не в БД"""
+        rated = set()
+        for view in self.views:
+            rated |= view['rated'].get(user_id, set())
+        return rated
+
+    async def flush(self):
+        """Записать накопленные оценки, вернуть их число"""
+        async with self._lock:
+            if not self.pending:
+                return 0
+            events, self.pending = self.pending, []
+            self.views.append(self._new_view())
+            try:
+                await self.db.run(record_likes, events)
+            except Exception:
+                # Вернуть события в начало буфера, следующий сброс повторит попытку
+                self.pending[:0] = events
+                self.views[-2]['likes'] |= self.views[-1]['likes']
+                for user_id, rated in self.views[-1]['rated'].items():
+                    self.views[-2]['rated'][user_id] |= rated
+                self.views.pop()
+                raise
+            self.views.pop(0)
+            return len(events)
+
+
+class MatchNotifier:
+    """Рассылка уведомлений о мэтчах из таблицы match_outbox"""
+
+    def __init__(self, db, snapshot):
+        self.db = db
+        self.snapshot = snapshot
+
+    def message_text(self, match_user_id):
+        record = self.snapshot.profile_of(match_user_id)
+        username = self.snapshot.usernames.get(match_user_id)
+        text = "💝 У вас новый мэтч!\n\n"
+        if record and record.name:
+            text += f"👤 {record.name}\n"
+        if username:
+            text += f"💬 Написать: @{username}\n🔗 Ссылка: https://t.me/{username}\n"
+        else:
+            text += f"🆔 ID пользователя: {match_user_id}\n"
+        return text + "\nВсе мэтчи — в разделе «💝 Мои мэтчи»"
+
+    async def drain(self, bot, worker_index=0, workers=1):
+        """Отправить созревшие уведомления своих пользователей, вернуть число доставленных"""
+        due = await self.db.fetchall(OUTBOX_DUE_SQL, (time.time(), workers, worker_index, OUTBOX_BATCH))
+        if not due:
+            return 0
+        results = await asyncio.gather(
+            *(self._send(bot, user_id, match_user_id) for _, user_id, match_user_id, _ in due),
+            return_exceptions=True
+        )
+        done = []
+        retry = []
+        for (event_id, user_id, match_user_id, attempts), result in zip(due, results):
+            if result is True:
+                done.append((event_id,))
+            elif isinstance(result, (Forbidden, BadRequest)) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logging.warning(f"Уведомление о мэтче для {user_id} снято: {result}")
+                done.append((event_id,))
+            else:
+                logging.warning(f"Уведомление о мэтче для {user_id} отложено: {result}")
+                retry.append((time.time() + OUTBOX_RETRY_DELAY * 2 ** attempts, event_id))
+        # Доставка «хотя бы один раз»: при падении до этой записи уведомления повторятся
+        await self.db.run(self._settle, done, retry)
+        return sum(result is True for result in results)
+
+    async def _send(self, bot, user_id, match_user_id):
+        # Без SendScheduler (бенчмарк, заглушка Bot API) полосы приоритета нет
+        await bot.send_message(
+            chat_id=user_id,
+            text=self.message_text(match_user_id),
+            rate_limit_args={'priority': SEND_BULK} if bot.rate_limiter else None
+        )
+        return True
+
+    @staticmethod
+    def _settle(cursor, done, retry):
+        cursor.executemany('DELETE FROM match_outbox WHERE event_id = ?', done)
+        cursor.executemany(
+            'UPDATE match_outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE event_id = ?',
+            retry
+        )
+
+
+def match_entry(name, username, faculty, bio, match_user_id):
+    """Блок одного мэтча в списке"""
+    display_name = name or username or "Пользователь"
+    if username:
+        contact = f"💬 Написать: @{username}\n🔗 Ссылка: https://t.me/{username}\n"
+    else:
+        contact = f"🆔 ID пользователя: {match_user_id}\n"
+    return (
+        f"👤 {display_name}\n"
+        f"🎓 Факультет: {faculty}\n"
+        f"📝 {bio}\n"
+        f"{contact}"
+        "━━━━━━━━━━━━━━━━━━━━\n\n"
+    )
+
+
+def match_page(cursor, user_id, key, forward, size):
+    """Страница мэтчей после (forward) или до ключа.
+
+    Из курсора читается не больше size + 1 строк: лишняя строка только
+    показывает, есть ли еще страница в этом направлении. Возвращает
+    (строки по возрастанию ключа, есть ли еще).
+    """
+    sql = MATCHES_NEXT_SQL if forward else MATCHES_PREV_SQL
+    rows = cursor.execute(sql, (user_id, key, size + 1)).fetchmany(size + 1)
+    more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+    return rows, more
+
+
+class MatchPages:
+    """Постраничный список мэтчей с коротким кэшем готовых страниц.
+
+    Страницы листаются по ключу (match_user_id), а не по OFFSET, так что
+    каждая стоит одного запроса по первичному ключу matches независимо от
+    номера. Готовая страница — (текст, ключ до, ключ после) — живет
+    MATCHES_PAGE_TTL секунд; открытие списка из меню сбрасывает кэш
+    пользователя.
+    """
+
+    def __init__(self, db, size=MATCHES_PAGE_SIZE, ttl=MATCHES_PAGE_TTL, max_size=MATCHES_PAGE_CACHE_SIZE):
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.max_size = max_size
+        # (user_id, forward, key) -> (время, страница)
+        self.pages = collections.OrderedDict()
+
+    async def get(self, user_id, forward=True, key=0):
+        """(текст, ключ для «назад» или None, ключ для «вперед» или None); текст None — мэтчей нет"""
+        cache_key = (user_id, forward, key)
+        cached = self.pages.get(cache_key)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            self.pages.move_to_end(cache_key)
+            return cached[1]
+
+        rows, more = await self.db.run(match_page, user_id, key, forward, self.size, write=False)
+        if not rows:
+            page = (None, None, None)
+        else:
+            has_prev = more if not forward else key != 0
+            has_next = more if forward else True
+            page = (
+                "💝 Ваши мэтчи:\n\n" + "".join(match_entry(*row) for row in rows),
+                rows[0][4] if has_prev else None,
+                rows[-1][4] if has_next else None
+            )
+        self.pages[cache_key] = (time.monotonic(), page)
+        while len(self.pages) > self.max_size:
+            self.pages.popitem(last=False)
+        return page
+
+    def forget(self, user_id):
+        """Сбросить страницы пользователя"""
+        for cache_key in [k for k in self.pages if k[0] == user_id]:
+            del self.pages[cache_key]
+
+    @staticmethod
+    def keyboard(before, after):
+        """Кнопки листания или None, если страница одна"""
+        buttons = []
+        if before is not None:
+            buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"matches_prev_{before}"))
+        if after is not None:
+            buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"matches_next_{after}"))
+        return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+class SQLiteStateBackend:
+    """Хранение состояний диалога в таблице user_states"""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def load(self, user_id):
+        """Вернуть (state, updated_at) или None"""
+        row = await self.db.fetchone(
+            'SELECT state, updated_at FROM user_states WHERE user_id = ?', (user_id,)
+        )
+        if not row:
+            return None
+        return json.loads(row[0]), row[1]
+
+    async def save(self, changes):
+        """Записать пачку изменений {user_id: (state или None, updated_at)}"""
+        await self.db.run(self._save, changes)
+
+    @staticmethod
+    def _save(cursor, changes):
+        for user_id, (state, updated_at) in changes.items():
+            if state is None:
+                cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
+            else:
+                cursor.execute(
+                    'INSERT OR REPLACE INTO user_states (user_id, state, updated_at) VALUES (?, ?, ?)',
+                    (user_id, json.dumps(state, ensure_ascii=False), updated_at)
+                )
+
+    async def expire(self, before):
+        """Удалить состояния, не менявшиеся с момента before"""
+        return await self.db.execute('DELETE FROM user_states WHERE updated_at < ?', (before,))
+
+
+class StateStore(BackgroundFlusher):
+    """Состояния незавершенного создания анкеты.
+
+    В памяти держится не больше max_size последних пользователей (LRU),
+    остальное лежит в backend и подгружается по требованию. Изменения
+    пишутся в backend пачкой раз в interval секунд, так что после
+    перезапуска пользователь продолжает с того же шага. Состояния, которые
+    не менялись дольше ttl секунд, удаляются и из памяти, и из backend.
+    """
+
+    def __init__(self, backend, max_size=STATE_CACHE_SIZE, ttl=STATE_TTL, interval=STATE_FLUSH_INTERVAL):
+        super().__init__()
+        self.backend = backend
+        self.max_size = max_size
+        self.ttl = ttl
+        self.interval = interval
+        # user_id -> (state или None, updated_at); None - "состояния нет"
+        self.cache = collections.OrderedDict()
+        self.dirty = {}
+        self._last_expire = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    async def get(self, user_id):
+        """Состояние пользователя (dict) или None"""
+        if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+            entry = self.cache[user_id]
+        elif user_id in self.dirty:
+            state, updated_at = self.dirty[user_id]
+            entry = (dict(state) if state is not None else None, updated_at)
+            self._remember(user_id, entry)
+        else:
+            entry = await self.backend.load(user_id) or (None, time.time())
+            self._remember(user_id, entry)
+        state, updated_at = entry
+        if state is not None and time.time() - updated_at > self.ttl:
+            self.delete(user_id)
+            return None
+        return state
+
+    def set(self, user_id, state):
+        """Сохранить состояние (после любого изменения шага или данных)"""
+        now = time.time()
+        self._remember(user_id, (state, now))
+        # Обработчики меняют dict из кэша на месте, а поток БД сериализует
+        # dirty при сбросе: на запись уходит копия
+        self.dirty[user_id] = (dict(state) if state is not None else None, now)
+
+    def delete(self, user_id):
+        self.set(user_id, None)
+
+    def _remember(self, user_id, entry):
+        self.cache[user_id] = entry
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_size:
+            # Вытесненное, но не записанное состояние остается в dirty до сброса
+            self.cache.popitem(last=False)
+
+    async def flush(self):
+        """Записать изменения в backend и удалить устаревшие состояния"""
+        now = time.time()
+        if self.dirty:
+            changes, self.dirty = self.dirty, {}
+            try:
+                await self.backend.save(changes)
+            except Exception:
+                for user_id, entry in changes.items():
+                    self.dirty.setdefault(user_id, entry)
+                raise
+        if now - self._last_expire > self.ttl / 10:
+            self._last_expire = now
+            for user_id, (state, updated_at) in list(self.cache.items()):
+                if now - updated_at > self.ttl:
+                    del self.cache[user_id]
+            await self.backend.expire(now - self.ttl)
+
+
+class Histogram:
+    """Гистограмма длительностей с фиксированными границами корзин (секунды)"""
+
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+              0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля: линейно внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                low = self.BOUNDS[i - 1] if i else 0.0
+                high = self.BOUNDS[i] if i < len(self.BOUNDS) else self.BOUNDS[-1]
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.BOUNDS[-1]
+
+
+class Metrics:
+    """Метрики процесса: гистограммы, счетчики и гауги.
+
+    Запись — поиск в словаре и инкремент под блокировкой (доли
+    микросекунды), поэтому метрики включены всегда. Гауги — функции,
+    которые вызываются только при выдаче метрик. Метки передаются кортежем
+    пар, например (('handler', 'find_profile'),).
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, fn, labels=()):
+        """Зарегистрировать гауг: fn() возвращает текущее значение"""
+        self.gauges[(name, labels)] = fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus"""
+        with self._lock:
+            histograms = [(key, list(h.counts), h.total, h.count) for key, h in self.histograms.items()]
+            counters = list(self.counters.items())
+        lines = []
+        for (name, labels), counts, total, count in sorted(histograms):
+            cumulative = 0
+            for bound, bucket in zip(Histogram.BOUNDS + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{self._labels(labels, (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        for (name, labels), value in sorted(counters):
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda item: item[0]):
+            try:
+                lines.append(f'{name}{self._labels(labels)} {fn()}')
+            except Exception as e:
+                logging.warning(f"Гауг {name} недоступен: {e}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Строки сводки для лога: число, p50 и p99 по каждой гистограмме"""
+        with self._lock:
+            items = sorted(self.histograms.items())
+            lines = [
+                f"{name}{self._labels(labels)}: n={h.count} "
+                f"p50={h.quantile(0.5) * 1000:.1f}ms p99={h.quantile(0.99) * 1000:.1f}ms"
+                for (name, labels), h in items
+            ]
+            lines += [f"{name}{self._labels(labels)}: {value}" for (name, labels), value in sorted(self.counters.items())]
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda item: item[0]):
+            try:
+                lines.append(f"{name}{self._labels(labels)}: {fn()}")
+            except Exception:
+                pass
+        return lines
+
+
+METRICS = Metrics()
+
+
+def instrumented(handler):
+    """Декоратор обработчика: время в handler_seconds и ошибки в handler_errors_total"""
+    labels = (('handler', handler.__name__),)
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            METRICS.inc('handler_errors_total', labels)
+            raise
+        finally:
+            METRICS.observe('handler_seconds', labels, time.perf_counter() - started)
+    return wrapper
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_label(sql):
+    """Имя запроса для метрик: имя константы *_SQL или начало текста"""
+    for name, value in globals().items():
+        if name.endswith('_SQL') and value == sql:
+            return name.lower()
+    return ' '.join(sql.split())[:60]
+
+
+class Database:
+    """Доступ к SQLite вне event loop.
+
+    Соединения открываются один раз на поток и живут до остановки бота.
+    Чтения идут в пул читателей, все записи - в единственный поток-писатель,
+    так что в режиме WAL поиск анкет не ждет записи лайков.
+    """
+
+    def __init__(self, db_name, readers=DB_WORKERS):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.reader = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix='db-read', initializer=self._open
+        )
+        self.writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='db-write', initializer=self._open
+        )
+
+    def connect(self):
+        """Новое соединение с настроенными pragma"""
+        conn = sqlite3.connect(
+            self.db_name, timeout=30, check_same_thread=False, cached_statements=256
+        )
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _open(self):
+        """Открыть соединение текущего потока пула (initializer)"""
+        conn = self.connect()
+        self._local.conn = conn
+        with self._lock:
+            self._connections.append(conn)
+
+    def _call(self, label, submitted, fn, *args):
+        """Выполнить fn(cursor, *args) на соединении текущего потока"""
+        conn = self._local.conn
+        started = time.perf_counter()
+        pool = 'write' if threading.current_thread().name.startswith('db-write') else 'read'
+        METRICS.observe('db_wait_seconds', (('pool', pool),), started - submitted)
+        try:
+            result = fn(conn.cursor(), *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            METRICS.inc('db_errors_total', (('statement', label),))
+            raise
+        finally:
+            METRICS.observe('db_query_seconds', (('statement', label),), time.perf_counter() - started)
+
+    async def run(self, fn, *args, write=True, label=None):
+        """Выполнить функцию с курсором в пуле потоков, не блокируя event loop"""
+        loop = asyncio.get_running_loop()
+        executor = self.writer if write else self.reader
+        call = functools.partial(self._call, label or fn.__name__, time.perf_counter(), fn, *args)
+        return await loop.run_in_executor(executor, call)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(
+            lambda cursor: cursor.execute(sql, params).fetchone(), write=False, label=sql_label(sql)
+        )
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(
+            lambda cursor: cursor.execute(sql, params).fetchall(), write=False, label=sql_label(sql)
+        )
+
+    async def execute(self, sql, params=()):
+        """Выполнить изменяющий запрос, вернуть число затронутых строк"""
+        return await self.run(lambda cursor: cursor.execute(sql, params).rowcount, label=sql_label(sql))
+
+    def queue_depth(self, write=False):
+        """Сколько вызовов ждут свободного потока пула"""
+        return (self.writer if write else self.reader)._work_queue.qsize()
+
+    def close(self):
+        self.reader.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+# Реализации слоя БД по схеме DATABASE_URL. Реализация повторяет интерфейс
+# Database: run(fn, *args, write=, label=) вызывает fn(cursor, *args) с
+# DB-API курсором, плюс fetchone/fetchall/execute/connect/queue_depth/close.
+# Запросы в коде написаны для SQLite.
+DATABASE_BACKENDS = {'sqlite': Database}
+
+
+def open_database(url, **kwargs):
+    """Слой БД по URL: 'sqlite:///путь' или просто путь к файлу SQLite"""
+    scheme, sep, address = url.partition('://')
+    if not sep:
+        scheme, address = 'sqlite', url
+    elif scheme == 'sqlite':
+        address = address[1:] if address.startswith('/') and not address.startswith('//') else address
+    if scheme not in DATABASE_BACKENDS:
+        raise ValueError(f"Неизвестная схема базы данных: {scheme}")
+    return DATABASE_BACKENDS[scheme](address, **kwargs)
+
+
+# Возрастная группа пользователя (первый ? — столбец с user_id), по его активной
+# или последней анкете
+EXPORT_AGE_BUCKET_SQL = f'''
+    (SELECT age / {EXPORT_AGE_STEP} * {EXPORT_AGE_STEP} FROM profiles
+     WHERE user_id = {{}} ORDER BY is_active DESC, profile_id DESC LIMIT 1)
+'''
+
+# Оценки из диапазона like_id, сгруппированные по дню, факультету анкеты и
+# возрастной группе свайпнувшего
+EXPORT_SWIPES_SQL = f'''
+    SELECT date(l.created_at), p.faculty, {EXPORT_AGE_BUCKET_SQL.format('l.from_user_id')},
+           COUNT(*), SUM(l.is_like)
+    FROM likes l
+    JOIN profiles p ON p.profile_id = l.to_profile_id
+    WHERE l.like_id > ? AND l.like_id <= ? AND l.created_at >= ?
+    GROUP BY 1, 2, 3
+'''
+
+# Мэтчи из диапазона user_id по дню и возрастной группе пользователя
+EXPORT_MATCHES_SQL = f'''
+    SELECT date(m.created_at), {EXPORT_AGE_BUCKET_SQL.format('m.user_id')}, COUNT(*)
+    FROM matches m
+    WHERE m.user_id > ? AND m.user_id <= ? AND m.created_at >= ?
+    GROUP BY 1, 2
+'''
+
+
+def first_like_since(conn, since):
+    """like_id, после которого все оценки не старше since (like_id растет вместе с created_at)"""
+    low, high = conn.execute('SELECT COALESCE(MIN(like_id), 0), COALESCE(MAX(like_id), 0) FROM likes').fetchone()
+    high += 1
+    while low < high:
+        middle = (low + high) // 2
+        row = conn.execute(
+            'SELECT created_at FROM likes WHERE like_id >= ? ORDER BY like_id LIMIT 1', (middle,)
+        ).fetchone()
+        if row and (row[0] or '') < since:
+            low = middle + 1
+        else:
+            high = middle
+    return low - 1
+
+
+def export_stats(db_name, out_dir=EXPORT_DIR, days=LIKES_ARCHIVE_DAYS, chunk=EXPORT_CHUNK):
+    """Выгрузить дневную статистику свайпов и мэтчей в CSV, вернуть пути файлов"""
+    # Дизлайки старше LIKES_ARCHIVE_DAYS уже в архиве без дат, поэтому период по умолчанию такой
+    since = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - float(days) * 86400))
+    # Диапазоны по chunk ключей, каждый своей короткой транзакцией и с паузой: писатель
+    # и checkpoint WAL не ждут выгрузку, а в памяти только суммы по дням и группам
+    conn = sqlite3.connect(f'file:{os.path.abspath(db_name)}?mode=ro', uri=True)
+    swipes = collections.defaultdict(lambda: [0, 0])
+    ages = collections.defaultdict(lambda: [0, 0, 0])
+    try:
+        # Граница на момент начала: оценки, пришедшие во время выгрузки, в нее не попадут
+        (last,) = conn.execute('SELECT COALESCE(MAX(like_id), 0) FROM likes').fetchone()
+        start = first_like_since(conn, since)
+        for low in range(start, last, chunk):
+            for day, faculty, bucket, count, likes in conn.execute(EXPORT_SWIPES_SQL, (low, low + chunk, since)):
+                swipes[day, faculty][0] += count
+                swipes[day, faculty][1] += likes
+                ages[day, bucket][0] += count
+                ages[day, bucket][1] += likes
+            time.sleep(EXPORT_PAUSE)
+
+        first, last = conn.execute(
+            'SELECT COALESCE(MIN(user_id), 0), COALESCE(MAX(user_id), 0) FROM matches'
+        ).fetchone()
+        # Диапазон user_id подобран так, чтобы в среднем на запрос приходилось около chunk мэтчей
+        (total,) = conn.execute('SELECT COUNT(*) FROM (SELECT 1 FROM matches LIMIT ?)', (chunk * 100,)).fetchone()
+        step = max(1, (last - first + 1) * chunk // max(total, 1))
+        for low in range(first - 1, last, step):
+            for day, bucket, count in conn.execute(EXPORT_MATCHES_SQL, (low, low + step, since)):
+                ages[day, bucket][2] += count
+            time.sleep(EXPORT_PAUSE)
+    finally:
+        conn.close()
+
+    def none_last(item):
+        # Ключ группы может содержать NULL (анкета без факультета, пользователь без анкеты)
+        return [(value is None, value if value is not None else 0) for value in item[0]]
+
+    def age_label(bucket):
+        return f'{bucket}-{bucket + EXPORT_AGE_STEP - 1}' if bucket is not None else 'нет анкеты'
+
+    os.makedirs(out_dir, exist_ok=True)
+    tables = {
+        'swipes_by_faculty.csv': (
+            ('day', 'faculty', 'swipes', 'likes', 'like_ratio'),
+            ((day, faculty, count, likes, f'{likes / count:.4f}')
+             for (day, faculty), (count, likes) in sorted(swipes.items(), key=none_last))
+        ),
+        'matches_by_age.csv': (
+            ('day', 'age_bucket', 'swipes', 'likes', 'like_ratio', 'matches', 'matches_per_like'),
+            ((day, age_label(bucket), count, likes, f'{likes / count:.4f}' if count else '',
+              matches, f'{matches / likes:.4f}' if likes else '')
+             for (day, bucket), (count, likes, matches) in sorted(ages.items(), key=none_last))
+        ),
+    }
+    paths = []
+    for name, (header, rows) in tables.items():
+        path = os.path.join(out_dir, name)
+        with open(path + '.partial', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        os.replace(path + '.partial', path)
+        paths.append(path)
+    return paths
+
+
+def lower_thread_priority():
+    """Понизить приоритет текущего потока (в Linux nice действует на поток)"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+def backup_database(db_name, backup_dir=BACKUP_DIR, keep=BACKUP_KEEP, pages=BACKUP_PAGES, pause=BACKUP_PAUSE):
+    """Снимок базы через online backup API: gzip-копия в backup_dir, вернуть ее путь.
+
+    Копирование идет шагами по pages страниц внутри одной читающей
+    транзакции: в WAL она не мешает писателю, а копия соответствует
+    моменту ее начала (без открытой транзакции backup начинался бы заново
+    после каждой чужой записи). Копия проверяется quick_check и сжимается
+    быстрым уровнем gzip, в каталоге остаются keep последних.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    prefix = os.path.splitext(os.path.basename(db_name))[0] + '-'
+    path = os.path.join(backup_dir, prefix + time.strftime('%Y%m%d-%H%M%S') + '.db.gz')
+    raw = path[:-len('.gz')] + '.partial'
+    source = sqlite3.connect(db_name, isolation_level=None)
+    target = sqlite3.connect(raw)
+    try:
+        source.execute('BEGIN')
+        source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        source.backup(target, pages=pages, sleep=pause)
+        source.execute('COMMIT')
+        # Копия — самостоятельный файл, без -wal рядом
+        target.execute('PRAGMA journal_mode = DELETE')
+        # quick_check в разы быстрее integrity_check (не сверяет индексы с
+        # таблицами); полная проверка выполняется при восстановлении
+        (result,) = target.execute('PRAGMA quick_check').fetchone()
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f"Копия базы повреждена: {result}")
+    finally:
+        source.close()
+        target.close()
+    try:
+        with open(raw, 'rb') as src, gzip.open(path + '.partial', 'wb', compresslevel=1) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(path + '.partial', path)
+    finally:
+        os.remove(raw)
+
+    backups = sorted(name for name in os.listdir(backup_dir) if name.startswith(prefix) and name.endswith('.db.gz'))
+    for name in backups[:-keep]:
+        os.remove(os.path.join(backup_dir, name))
+    return path
+
+
+def restore_backup(path, db_name):
+    """Восстановить базу из gzip-копии (бот должен быть остановлен)"""
+    raw = db_name + '.restore'
+    with gzip.open(path, 'rb') as src, open(raw, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    conn = sqlite3.connect(raw)
+    try:
+        (result,) = conn.execute('PRAGMA integrity_check').fetchone()
+        (version,) = conn.execute('PRAGMA user_version').fetchone()
+    finally:
+        conn.close()
+    if result != 'ok':
+        os.remove(raw)
+        raise sqlite3.DatabaseError(f"Копия базы повреждена: {result}")
+    # Старый WAL относится к заменяемому файлу и не должен примениться к копии
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(db_name + suffix):
+            os.remove(db_name + suffix)
+    os.replace(raw, db_name)
+    return version
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 - уже доступен)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(self.blocked_until - now, 0)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Telegram попросил подождать (RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle(self, now):
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+class SendScheduler(BaseRateLimiter):
+    """Планировщик исходящих запросов к Bot API.
+
+    Каждый запрос с chat_id ждет токен в корзине своего чата и в общей
+    корзине бота. Если общих токенов не хватает, запросы полосы
+    SEND_INTERACTIVE проходят раньше SEND_BULK (полоса задается через
+    rate_limit_args={'priority': SEND_BULK}). На RetryAfter чат (или весь
+    бот) блокируется на указанное время, и запрос повторяется.
+    """
+
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, group_rate=SEND_GROUP_RATE,
+                 max_retries=SEND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        # Сколько запросов каждой полосы ждут только общий токен
+        self.waiting = [0, 0]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > self.MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                for key in [key for key, b in self.chat_buckets.items() if b.idle(now)]:
+                    del self.chat_buckets[key]
+            # Отрицательный chat_id - группа, у групп свой, более строгий лимит
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, 1 if is_group else self.chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id, lane):
+        chat = self._chat_bucket(chat_id)
+        # Сначала ждем свой чат, не занимая очередь за общими токенами
+        while (delay := chat.delay(time.monotonic())) > 0:
+            await asyncio.sleep(delay)
+        self.waiting[lane] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                delay = self.global_bucket.delay(now)
+                if delay <= 0 and not any(self.waiting[:lane]) and chat.delay(now) <= 0:
+                    self.global_bucket.take()
+                    chat.take()
+                    return
+                await asyncio.sleep(max(delay, chat.delay(now), 0.005))
+        finally:
+            self.waiting[lane] -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        lane = (rate_limit_args or {}).get('priority', SEND_INTERACTIVE)
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self._acquire(chat_id, lane)
+            labels = (('endpoint', endpoint),)
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                METRICS.observe('telegram_api_seconds', labels, time.perf_counter() - started)
+                return result
+            except RetryAfter as e:
+                METRICS.observe('telegram_api_seconds', labels, time.perf_counter() - started)
+                METRICS.inc('telegram_api_errors_total', labels + (('error', 'RetryAfter'),))
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"{endpoint}: flood limit, повтор через {e.retry_after} с")
+                if chat_id is None:
+                    self.global_bucket.block(e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    self._chat_bucket(chat_id).block(e.retry_after)
+            except Exception as e:
+                METRICS.observe('telegram_api_seconds', labels, time.perf_counter() - started)
+                METRICS.inc('telegram_api_errors_total', labels + (('error', type(e).__name__),))
+                raise
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно, а
+    обновления одного пользователя ждут друг друга, так что шаги создания
+    анкеты и оценки не перемешиваются.
+    """
+
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self.locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await coroutine
+            return
+        # user_id -> [блокировка, сколько обновлений ее держат или ждут]
+        entry = self.locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class HttpServer:
+    """Минимальный HTTP/1.1-сервер на asyncio с keep-alive.
+
+    Наследники реализуют _handle_request: он возвращает код ответа или
+    (код, тело, Content-Type).
+    """
+
+    MAX_BODY = 1024 * 1024
+
     def __init__(self):
-        self.db_name = 'dating_bot.db'
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > self.MAX_BODY:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                response = await self._handle_request(method, target, headers, body)
+                if isinstance(response, int):
+                    response = (response, b'', None)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, *response, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method, target, headers, body):
+        raise NotImplementedError
+
+    @staticmethod
+    async def _respond(writer, status, body=b'', content_type=None, close=False):
+        reason = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                  405: 'Method Not Allowed', 413: 'Payload Too Large'}[status]
+        connection = 'close' if close else 'keep-alive'
+        head = f'HTTP/1.1 {status} {reason}\r\nContent-Length: {len(body)}\r\n'
+        if content_type:
+            head += f'Content-Type: {content_type}\r\n'
+        writer.write((head + f'Connection: {connection}\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+
+class WebhookServer(HttpServer):
+    """HTTP-сервер для приема обновлений от Telegram.
+
+    Принимает POST на path, проверяет заголовок секретного токена и кладет
+    обновление в update_queue приложения. Поддерживает keep-alive, так что
+    Telegram может слать обновления по нескольким соединениям параллельно.
+    """
+
+    def __init__(self, application=None, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, deliver=None):
+        super().__init__()
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        # deliver(data) вместо update_queue: так роутер раздает обновления воркерам
+        self.deliver = deliver
+
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        return await super().start(host, port)
+
+    async def _handle_request(self, method, target, headers, body):
+        if target.split('?', 1)[0] != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if self.secret_token and headers.get('x-telegram-bot-api-secret-token') != self.secret_token:
+            return 403
+        try:
+            data = json.loads(body)
+            if self.deliver:
+                await self.deliver(data)
+                return 200
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400
+        await self.application.update_queue.put(update)
+        return 200
+
+
+class MetricsServer(HttpServer):
+    """Отдает METRICS в формате Prometheus на GET METRICS_PATH"""
+
+    def __init__(self, metrics=METRICS, path=METRICS_PATH):
+        super().__init__()
+        self.metrics = metrics
+        self.path = path
+
+    async def start(self, host=METRICS_LISTEN, port=METRICS_PORT):
+        return await super().start(host, port)
+
+    async def _handle_request(self, method, target, headers, body):
+        if target.split('?', 1)[0] != self.path:
+            return 404
+        if method != 'GET':
+            return 405
+        return 200, self.metrics.render().encode(), 'text/plain; version=0.0.4'
+
+
+class DatingBot:
+    def __init__(self, db_name=DATABASE_URL, worker_index=0, workers=1):
+        self.db_name = db_name
+        # Номер воркера и их число: воркер обслуживает пользователей с user_id % workers == worker_index
+        self.worker_index = worker_index
+        self.workers = workers
+        self.last_change_id = 0
+        self.last_prune = 0.0
+        self.db = open_database(self.db_name)
         self.setup_database()
-        self.user_states = {}
+        self.swipes = SwipeBuffer(self.db)
+        self.seen = SeenIndex(self.db, self.swipes)
+        self.swipe_dedup = SwipeDedup()
+        self.captions = CaptionCache()
+        self.prefs = SearchPrefsStore(self.db)
+        self.discovery = DiscoveryIndex()
+        self.profiles = ProfileSnapshot()
+        self.profiles.subscribe(self.discovery.on_change)
+        self.notifier = MatchNotifier(self.db, self.profiles)
+        self.match_pages = MatchPages(self.db)
+        self.metrics_server = None
+        self.register_gauges()
+        self.recommender = Recommender(self.db, self.profiles, self.discovery, self.swipes)
+        self.candidates = CandidateQueue(
+            self.profiles, self.recommender, self.swipes, self.seen, self.captions, self.prefs
+        )
+        self.user_states = StateStore(SQLiteStateBackend(self.db))
 
     def setup_database(self):
         """Создание базы данных и таблиц"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица анкет
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS profiles (
-                profile_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                name TEXT,
-                photo_id TEXT,
-                gender TEXT,
-                faculty TEXT,
-                age INTEGER,
-                bio TEXT,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица лайков
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS likes (
-                like_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                from_user_id INTEGER,
-                to_profile_id INTEGER,
-                is_like BOOLEAN,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
+        conn = self.db.connect()
+        version = migrate(conn)
+        for name, detail in check_query_plans(conn):
+            logging.warning(f"Запрос {name} читает больше строк, чем нужно: {detail}")
         conn.close()
-        print("✅ База данных создана!")
+        print(f"✅ База данных создана! Версия схемы: {version}")
 
     def get_main_menu_keyboard(self):
         """Клавиатура главного меню"""
-        keyboard = [
-            [KeyboardButton("👤 Создать анкету")],
-            [KeyboardButton("🔍 Найти анкету"), KeyboardButton("💝 Мои мэтчи")],
-            [KeyboardButton("📊 Моя анкета"), KeyboardButton("❌ Удалить анкету")]
-        ]
-        return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        return MAIN_MENU_KEYBOARD
 
     def get_faculty_keyboard(self):
         """Клавиатура выбора факультета"""
-        # Создаем 3 колонки для лучшего отображения
-        buttons = []
-        faculty_codes = list(FACULTIES.keys())
-        
-        # Разбиваем на строки по 3 элемента
-        for i in range(0, len(faculty_codes), 3):
-            row = []
-            for code in faculty_codes[i:i+3]:
-                row.append(InlineKeyboardButton(code, callback_data=f"faculty_{code}"))
-            buttons.append(row)
-        
-        return InlineKeyboardMarkup(buttons)
+        return FACULTY_KEYBOARD
 
+    @instrumented
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user = update.effective_user
         
         # Добавляем пользователя в БД
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
-            VALUES (?, ?, ?, ?)
-        ''', (user.id, user.username, user.first_name, user.last_name))
-        conn.commit()
-        conn.close()
+        await self.db.run(self._save_user, user.id, user.username, user.first_name, user.last_name)
+        self.profiles.set_username(user.id, user.username)
         
         welcome_text = (
             "👋 Добро пожаловать в бот знакомств!\n\n"
@@ -137,14 +2723,22 @@ class DatingBot:
             reply_markup=self.get_main_menu_keyboard()
         )
 
+    @instrumented
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
         text = update.message.text
         user_id = update.effective_user.id
         
         # Проверяем, находится ли пользователь в процессе создания анкеты
-        if user_id in self.user_states:
-            state = self.user_states[user_id].get('step')
+        user_state = await self.user_states.get(user_id)
+        if user_state and user_state.get('prompt') == 'pref_age':
+            if text not in MAIN_MENU_TEXTS:
+                await self.handle_pref_age(update, context)
+                return
+            # Кнопка меню отменяет ввод возраста для фильтра
+            self.clear_prompt(user_id, user_state)
+        elif user_state:
+            state = user_state.get('step')
             
             if state == 'waiting_name':
                 await self.handle_name(update, context)
@@ -167,17 +2761,120 @@ class DatingBot:
             await self.show_my_profile(update, context)
         elif text == "❌ Удалить анкету":
             await self.delete_profile(update, context)
+        elif text == "⚙️ Фильтры":
+            await self.show_filters(update, context)
+
+    def filters_text(self, prefs):
+        """Описание текущих фильтров поиска"""
+        prefs = prefs or {}
+        gender = {'male': "👨 Мужской", 'female': "👩 Женский"}.get(prefs.get('gender'), "любой")
+        age_min, age_max = prefs.get('age_min'), prefs.get('age_max')
+        if age_min is None and age_max is None:
+            age = "любой"
+        else:
+            age = f"{age_min or 16}-{age_max or 100}"
+        faculties = ", ".join(sorted(prefs.get('faculties') or ())) or "все"
+        return (
+            "⚙️ Фильтры поиска\n\n"
+            f"👫 Пол: {gender}\n"
+            f"📅 Возраст: {age}\n"
+            f"🎓 Факультеты: {faculties}"
+        )
+
+    def filters_keyboard(self, prefs):
+        """Кнопки настройки фильтров; выбранные факультеты отмечены"""
+        prefs = prefs or {}
+        selected = prefs.get('faculties') or frozenset()
+        buttons = [[
+            InlineKeyboardButton("👨", callback_data="pref_g_male"),
+            InlineKeyboardButton("👩", callback_data="pref_g_female"),
+            InlineKeyboardButton("Любой пол", callback_data="pref_g_any")
+        ]]
+        codes = list(FACULTIES.keys())
+        for i in range(0, len(codes), 3):
+            buttons.append([
+                InlineKeyboardButton(("✅ " if code in selected else "") + code, callback_data=f"pref_f_{code}")
+                for code in codes[i:i+3]
+            ])
+        buttons.append([
+            InlineKeyboardButton("📅 Возраст", callback_data="pref_age"),
+            InlineKeyboardButton("♻️ Сбросить", callback_data="pref_reset")
+        ])
+        return InlineKeyboardMarkup(buttons)
+
+    @instrumented
+    async def show_filters(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показать фильтры поиска"""
+        prefs = await self.prefs.get(update.effective_user.id)
+        await update.message.reply_text(self.filters_text(prefs), reply_markup=self.filters_keyboard(prefs))
+
+    @instrumented
+    async def handle_filter_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик кнопок фильтров поиска"""
+        query = update.callback_query
+        await query.answer()
+        
+        user_id = query.from_user.id
+        prefs = dict(await self.prefs.get(user_id) or {})
+        data = query.data
+        
+        if data.startswith('pref_g_'):
+            gender = data[len('pref_g_'):]
+            prefs['gender'] = None if gender == 'any' else gender
+        elif data.startswith('pref_f_'):
+            code = data[len('pref_f_'):]
+            prefs['faculties'] = frozenset(prefs.get('faculties') or ()) ^ {code}
+        elif data == 'pref_reset':
+            prefs = None
+        elif data == 'pref_age':
+            # Отдельный ключ: шаг незавершенного создания анкеты не теряется
+            state = dict(await self.user_states.get(user_id) or {})
+            state['prompt'] = 'pref_age'
+            self.user_states.set(user_id, state)
+            await query.message.reply_text("📅 Введите диапазон возраста, например 18-25:")
+            return
+        
+        await self.prefs.set(user_id, prefs)
+        self.candidates.reset(user_id)
+        prefs = await self.prefs.get(user_id)
+        await query.edit_message_text(self.filters_text(prefs), reply_markup=self.filters_keyboard(prefs))
+
+    @instrumented
+    async def handle_pref_age(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик ввода диапазона возраста для фильтра"""
+        user_id = update.effective_user.id
+        match = re.fullmatch(r'\s*(\d+)\s*(?:-|–|\s)\s*(\d+)\s*', update.message.text)
+        if not match:
+            await update.message.reply_text("Введите два числа через дефис, например 18-25:")
+            return
+        age_min, age_max = sorted(int(value) for value in match.groups())
+        if age_min < 16 or age_max > 100:
+            await update.message.reply_text("Возраст должен быть в пределах 16-100. Попробуйте снова:")
+            return
+        
+        self.clear_prompt(user_id, await self.user_states.get(user_id) or {})
+        prefs = dict(await self.prefs.get(user_id) or {})
+        prefs['age_min'], prefs['age_max'] = age_min, age_max
+        await self.prefs.set(user_id, prefs)
+        self.candidates.reset(user_id)
+        prefs = await self.prefs.get(user_id)
+        await update.message.reply_text(self.filters_text(prefs), reply_markup=self.filters_keyboard(prefs))
 
+    def clear_prompt(self, user_id, state):
+        """Снять ожидание ввода фильтра, оставив шаг создания анкеты"""
+        state = {key: value for key, value in state.items() if key != 'prompt'}
+        if state:
+            self.user_states.set(user_id, state)
+        else:
+            self.user_states.delete(user_id)
+
+    @instrumented
     async def start_create_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начало создания анкеты"""
         user_id = update.effective_user.id
         
         # Проверяем, есть ли уже анкета
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM profiles WHERE user_id = ? AND is_active = TRUE', (user_id,))
-        existing_profile = cursor.fetchone()
-        conn.close()
+        existing_profile = self.profiles.profile_of(user_id)
         
         if existing_profile:
             await update.message.reply_text(
@@ -186,14 +2883,16 @@ class DatingBot:
             )
             return
         
-        self.user_states[user_id] = {'step': 'waiting_name'}
+        self.user_states.set(user_id, {'step': 'waiting_name'})
         await update.message.reply_text("👤 Введите ваше имя (как вас будут видеть другие пользователи):")
 
+    @instrumented
     async def handle_name(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ввода имени"""
         user_id = update.effective_user.id
         
-        if user_id not in self.user_states or self.user_states[user_id].get('step') != 'waiting_name':
+        state = await self.user_states.get(user_id)
+        if not state or state.get('step') != 'waiting_name':
             return
         
         name = update.message.text.strip()
@@ -206,31 +2905,38 @@ class DatingBot:
             await update.message.reply_text("Имя слишком длинное. Максимум 50 символов. Попробуйте снова:")
             return
         
-        self.user_states[user_id]['name'] = name
-        self.user_states[user_id]['step'] = 'waiting_photo'
+        state['name'] = name
+        state['step'] = 'waiting_photo'
+        self.user_states.set(user_id, state)
         await update.message.reply_text(f"✅ Имя сохранено: {name}\n\n📸 Теперь пришлите ваше фото для анкеты:")
 
+    @instrumented
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик фотографий"""
         user_id = update.effective_user.id
         
-        if user_id not in self.user_states or self.user_states[user_id].get('step') != 'waiting_photo':
+        state = await self.user_states.get(user_id)
+        if not state or state.get('step') != 'waiting_photo':
             return
         
-        photo_file = await update.message.photo[-1].get_file()
-        self.user_states[user_id]['photo_id'] = photo_file.file_id
-        self.user_states[user_id]['step'] = 'waiting_gender'
+        # file_id уже есть в сообщении, getFile для него не нужен
+        photo = pick_photo(update.message.photo)
+        owner = await self.db.fetchone(PHOTO_OWNER_SQL, (photo.file_unique_id,))
+        if owner and owner[0] != user_id and self.profiles.by_user.get(owner[0]):
+            await update.message.reply_text(
+                "Это фото уже используется в другой анкете. Отправьте свое фото:"
+            )
+            return
         
-        keyboard = [
-            [
-                InlineKeyboardButton("👨 Мужской", callback_data="gender_male"),
-                InlineKeyboardButton("👩 Женский", callback_data="gender_female")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Метаданные запишутся вместе с анкетой
+        state['photo_id'] = photo.file_id
+        state['photo'] = [photo.file_unique_id, photo.width, photo.height, photo.file_size]
+        state['step'] = 'waiting_gender'
+        self.user_states.set(user_id, state)
         
-        await update.message.reply_text("Выберите ваш пол:", reply_markup=reply_markup)
+        await update.message.reply_text("Выберите ваш пол:", reply_markup=GENDER_KEYBOARD)
 
+    @instrumented
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на кнопки"""
         query = update.callback_query
@@ -238,28 +2944,33 @@ class DatingBot:
         
         user_id = query.from_user.id
         
-        if user_id not in self.user_states:
+        state = await self.user_states.get(user_id)
+        if not state:
             return
             
         if query.data.startswith('gender_'):
             gender = query.data.split('_')[1]
-            self.user_states[user_id]['gender'] = gender
-            self.user_states[user_id]['step'] = 'waiting_age'
+            state['gender'] = gender
+            state['step'] = 'waiting_age'
+            self.user_states.set(user_id, state)
             await query.edit_message_text("📅 Введите ваш возраст:")
             
         elif query.data.startswith('faculty_'):
             faculty_code = query.data.split('_')[1]
             faculty_name = FACULTIES.get(faculty_code, faculty_code)
-            self.user_states[user_id]['faculty'] = faculty_name
-            self.user_states[user_id]['step'] = 'waiting_bio'
+            state['faculty'] = faculty_name
+            state['step'] = 'waiting_bio'
+            self.user_states.set(user_id, state)
             await query.edit_message_text(f"✅ Выбран факультет: {faculty_name}\n\n✏️ Теперь напишите информацию о себе (максимум 500 символов):")
 
+    @instrumented
     async def handle_age(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ввода возраста"""
         user_id = update.effective_user.id
         
         # Проверяем состояние
-        if user_id not in self.user_states or self.user_states[user_id].get('step') != 'waiting_age':
+        state = await self.user_states.get(user_id)
+        if not state or state.get('step') != 'waiting_age':
             # Если не ожидаем возраст, игнорируем сообщение
             return
         
@@ -269,8 +2980,9 @@ class DatingBot:
                 await update.message.reply_text("Пожалуйста, введите реальный возраст (16-100):")
                 return
                 
-            self.user_states[user_id]['age'] = age
-            self.user_states[user_id]['step'] = 'waiting_faculty'
+            state['age'] = age
+            state['step'] = 'waiting_faculty'
+            self.user_states.set(user_id, state)
             
             await update.message.reply_text(
                 "🎓 Выберите ваш факультет:",
@@ -280,13 +2992,15 @@ class DatingBot:
         except ValueError:
             await update.message.reply_text("Пожалуйста, введите число:")
 
+    @instrumented
     async def handle_bio(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ввода информации о себе"""
         user_id = update.effective_user.id
         bio = update.message.text
         
         # Проверяем состояние
-        if user_id not in self.user_states or self.user_states[user_id].get('step') != 'waiting_bio':
+        state = await self.user_states.get(user_id)
+        if not state or state.get('step') != 'waiting_bio':
             return
         
         if len(bio) > 500:
@@ -294,16 +3008,10 @@ class DatingBot:
             return
         
         # Сохраняем анкету
-        profile_data = self.user_states[user_id]
-        
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        profile_data = state
         
         try:
-            cursor.execute('''
-                INSERT INTO profiles (user_id, name, photo_id, gender, faculty, age, bio)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
+            fields = (
                 user_id, 
                 profile_data.get('name', ''),
                 profile_data.get('photo_id', ''), 
@@ -311,11 +3019,11 @@ class DatingBot:
                 profile_data.get('faculty', ''), 
                 profile_data.get('age', 0), 
                 bio
-            ))
-            conn.commit()
+            )
+            await self.create_profile(fields, profile_data.get('photo'))
             
             # Очищаем состояние
-            del self.user_states[user_id]
+            self.user_states.delete(user_id)
             
             await update.message.reply_text(
                 "✅ Ваша анкета успешно создана!\n\n"
@@ -329,19 +3037,14 @@ class DatingBot:
                 "❌ Произошла ошибка при создании анкеты. Попробуйте снова.",
                 reply_markup=self.get_main_menu_keyboard()
             )
-        finally:
-            conn.close()
 
+    @instrumented
     async def find_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Поиск случайной анкеты"""
         user_id = update.effective_user.id
         
         # Проверяем, есть ли анкета у пользователя
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM profiles WHERE user_id = ? AND is_active = TRUE', (user_id,))
-        user_profile = cursor.fetchone()
-        conn.close()
+        user_profile = self.profiles.profile_of(user_id)
         
         if not user_profile:
             await update.message.reply_text(
@@ -350,25 +3053,10 @@ class DatingBot:
             )
             return
         
-        # Ищем случайную анкету (кроме своей и уже оцененных)
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT p.*, u.username 
-            FROM profiles p
-            LEFT JOIN users u ON p.user_id = u.user_id
-            WHERE p.user_id != ? 
-            AND p.is_active = TRUE 
-            AND p.profile_id NOT IN (
-                SELECT to_profile_id FROM likes WHERE from_user_id = ?
-            )
-            ORDER BY RANDOM() LIMIT 1
-        ''', (user_id, user_id))
-        
-        result = cursor.fetchone()
-        conn.close()
+        # Берем следующую анкету из очереди (кроме своей и уже оцененных)
+        card = await self.candidates.next(user_id)
         
-        if not result:
+        if not card:
             await update.message.reply_text(
                 "😔 Вы просмотрели все анкеты!\n"
                 "Попробуйте позже или настройки могут измениться.",
@@ -376,78 +3064,47 @@ class DatingBot:
             )
             return
         
-        # Распаковываем результат
-        (profile_id, profile_user_id, name, photo_id, gender, 
-         faculty, age, bio, is_active, created_at, username) = result
-        
-        gender_emoji = "👨" if gender == "male" else "👩"
-        display_name = name or "Пользователь"
-        
-        caption = (
-            f"{gender_emoji} {display_name}\n"
-            f"🎓 Факультет: {faculty}\n"
-            f"📅 Возраст: {age}\n"
-            f"📝 О себе: {bio}"
-        )
-        
-        # Сохраняем текущий профиль в контексте
-        context.user_data['current_profile'] = {
-            'profile_id': profile_id,
-            'user_id': profile_user_id,
-            'username': username
-        }
-        
-        # Только кнопки лайк/дизлайк (без кнопки "следующая")
-        keyboard = [
-            [
-                InlineKeyboardButton("❤️ Лайк", callback_data="like"),
-                InlineKeyboardButton("👎 Дизлайк", callback_data="dislike")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_photo(
-            photo=photo_id,
-            caption=caption,
-            reply_markup=reply_markup
+        await self.send_profile_card(update.message, context, card)
+
+    async def send_profile_card(self, message, context: ContextTypes.DEFAULT_TYPE, card):
+        """Отправить карточку анкеты с кнопками лайк/дизлайк"""
+        await message.reply_photo(
+            photo=card['photo_id'],
+            caption=card['caption'],
+            reply_markup=swipe_keyboard(message.chat_id, card)
         )
 
+    @instrumented
     async def handle_like(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик лайков/дизлайков"""
+        """Обработчик лайков/дизлайков.
+
+        Анкета берется из подписанной callback_data, а не из user_data, так
+        что обработчик не зависит от порядка обновлений пользователя.
+        """
         query = update.callback_query
-        await query.answer()
-        
         user_id = query.from_user.id
-        action = query.data
         
-        current_profile = context.user_data.get('current_profile')
-        if not current_profile:
-            await query.edit_message_text("Произошла ошибка. Попробуйте снова.")
+        swipe = parse_swipe_data(user_id, query.data)
+        if not swipe:
+            # Кнопки старого формата или с неверной подписью
+            await query.answer()
+            await query.edit_message_text("Эта карточка устарела.")
+            await self.show_next_profile(query, context)
             return
+        action, profile_id, profile_user_id = swipe
         
-        profile_id = current_profile['profile_id']
-        profile_user_id = current_profile['user_id']
-        username = current_profile['username']
+        # Повторное нажатие на ту же карточку уже учтено
+        if not self.swipe_dedup.first(user_id, profile_id):
+            await query.answer("Уже учтено")
+            return
+        await query.answer()
         
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        username = self.profiles.usernames.get(profile_user_id)
+        self.seen.add(user_id, profile_id)
         
         if action == 'like':
-            # Сохраняем лайк
-            cursor.execute('''
-                INSERT OR REPLACE INTO likes (from_user_id, to_profile_id, is_like)
-                VALUES (?, ?, ?)
-            ''', (user_id, profile_id, True))
-            
-            conn.commit()
-            
-            # Проверяем, взаимный ли это лайк
-            cursor.execute('''
-                SELECT 1 FROM likes 
-                WHERE from_user_id = ? AND to_profile_id = ? AND is_like = TRUE
-            ''', (profile_user_id, profile_id))
-            
-            is_mutual = cursor.fetchone()
+            # Сохраняем лайк и сразу проверяем, взаимный ли он
+            is_mutual = await self.swipes.add(user_id, profile_id, profile_user_id, True)
             
             if is_mutual:
                 # Взаимный лайк - показываем ссылку
@@ -479,13 +3136,7 @@ class DatingBot:
                 
         elif action == 'dislike':
             # Сохраняем дизлайк
-            cursor.execute('''
-                INSERT OR REPLACE INTO likes (from_user_id, to_profile_id, is_like)
-                VALUES (?, ?, ?)
-            ''', (user_id, profile_id, False))
-            
-            conn.commit()
-            conn.close()
+            await self.swipes.add(user_id, profile_id, profile_user_id, False)
             
             await query.edit_message_text("👎 Вы поставили дизлайк")
             
@@ -496,26 +3147,10 @@ class DatingBot:
         """Показать следующую анкету после действия"""
         user_id = query.from_user.id
         
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # Ищем случайную анкету (кроме своей и уже оцененных)
-        cursor.execute('''
-            SELECT p.*, u.username 
-            FROM profiles p
-            LEFT JOIN users u ON p.user_id = u.user_id
-            WHERE p.user_id != ? 
-            AND p.is_active = TRUE 
-            AND p.profile_id NOT IN (
-                SELECT to_profile_id FROM likes WHERE from_user_id = ?
-            )
-            ORDER BY RANDOM() LIMIT 1
-        ''', (user_id, user_id))
-        
-        result = cursor.fetchone()
-        conn.close()
+        # Берем следующую анкету из очереди (кроме своей и уже оцененных)
+        card = await self.candidates.next(user_id)
         
-        if not result:
+        if not card:
             await query.message.reply_text(
                 "😔 Вы просмотрели все доступные анкеты!\n"
                 "Возвращайтесь позже, когда появятся новые анкеты.",
@@ -523,66 +3158,19 @@ class DatingBot:
             )
             return
         
-        # Распаковываем результат
-        (profile_id, profile_user_id, name, photo_id, gender, 
-         faculty, age, bio, is_active, created_at, username) = result
-        
-        gender_emoji = "👨" if gender == "male" else "👩"
-        display_name = name or "Пользователь"
-        
-        caption = (
-            f"{gender_emoji} {display_name}\n"
-            f"🎓 Факультет: {faculty}\n"
-            f"📅 Возраст: {age}\n"
-            f"📝 О себе: {bio}"
-        )
-        
-        # Сохраняем текущий профиль в контексте
-        context.user_data['current_profile'] = {
-            'profile_id': profile_id,
-            'user_id': profile_user_id,
-            'username': username
-        }
-        
-        # Только кнопки лайк/дизлайк
-        keyboard = [
-            [
-                InlineKeyboardButton("❤️ Лайк", callback_data="like"),
-                InlineKeyboardButton("👎 Дизлайк", callback_data="dislike")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.message.reply_photo(
-            photo=photo_id,
-            caption=caption,
-            reply_markup=reply_markup
-        )
+        await self.send_profile_card(query.message, context, card)
 
+    @instrumented
     async def show_matches(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать мэтчи пользователя"""
         user_id = update.effective_user.id
         
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # Находим взаимные лайки
-        cursor.execute('''
-            SELECT p.name, u.username, p.faculty, p.bio, u.user_id
-            FROM likes l1
-            JOIN likes l2 ON l1.to_profile_id = l2.from_user_id
-            JOIN profiles p ON l2.from_user_id = p.user_id
-            JOIN users u ON p.user_id = u.user_id
-            WHERE l1.from_user_id = ? 
-            AND l2.to_profile_id = l1.from_user_id
-            AND l1.is_like = TRUE 
-            AND l2.is_like = TRUE
-        ''', (user_id,))
-        
-        matches = cursor.fetchall()
-        conn.close()
+        # Находим взаимные лайки (сначала дописываем отложенные оценки)
+        await self.swipes.flush()
+        self.match_pages.forget(user_id)
+        match_text, before, after = await self.match_pages.get(user_id)
         
-        if not matches:
+        if not match_text:
             await update.message.reply_text(
                 "😔 У вас пока нет мэтчей.\n"
                 "Продолжайте ставить лайки!",
@@ -590,37 +3178,34 @@ class DatingBot:
             )
             return
         
-        match_text = "💝 Ваши мэтчи:\n\n"
-        for match in matches:
-            name, username, faculty, bio, match_user_id = match
-            display_name = name or username or "Пользователь"
-            
-            match_text += f"👤 {display_name}\n"
-            match_text += f"🎓 Факультет: {faculty}\n"
-            match_text += f"📝 {bio}\n"
-            
-            if username:
-                match_text += f"💬 Написать: @{username}\n"
-                match_text += f"🔗 Ссылка: https://t.me/{username}\n"
-            else:
-                match_text += f"🆔 ID пользователя: {match_user_id}\n"
-            
-            match_text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-        
         await update.message.reply_text(
             match_text,
-            reply_markup=self.get_main_menu_keyboard()
+            reply_markup=MatchPages.keyboard(before, after) or self.get_main_menu_keyboard()
+        )
+
+    @instrumented
+    async def handle_matches_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик кнопок листания мэтчей"""
+        query = update.callback_query
+        await query.answer()
+        
+        _, direction, key = query.data.split('_')
+        match_text, before, after = await self.match_pages.get(
+            query.from_user.id, direction == 'next', int(key)
         )
+        
+        if not match_text:
+            await query.edit_message_text("😔 На этой странице мэтчей больше нет.")
+            return
+        
+        await query.edit_message_text(match_text, reply_markup=MatchPages.keyboard(before, after))
 
+    @instrumented
     async def show_my_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать анкету пользователя"""
         user_id = update.effective_user.id
         
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM profiles WHERE user_id = ? AND is_active = TRUE', (user_id,))
-        profile = cursor.fetchone()
-        conn.close()
+        profile = self.profiles.profile_of(user_id)
         
         if not profile:
             await update.message.reply_text(
@@ -629,42 +3214,217 @@ class DatingBot:
             )
             return
         
-        profile_id, user_id, name, photo_id, gender, faculty, age, bio, is_active, created_at = profile
-        gender_text = "Мужской" if gender == "male" else "Женский"
-        
-        caption = (
-            f"👤 Ваша анкета:\n\n"
-            f"📛 Имя: {name}\n"
-            f"🎓 Факультет: {faculty}\n"
-            f"👫 Пол: {gender_text}\n"
-            f"📅 Возраст: {age}\n"
-            f"📝 О себе: {bio}"
+        caption = self.captions.get(
+            'own', profile.profile_id, own_profile_caption,
+            profile.name, profile.gender, profile.faculty, profile.age, profile.bio
         )
         
         await update.message.reply_photo(
-            photo=photo_id,
+            photo=profile.photo_id,
             caption=caption,
             reply_markup=self.get_main_menu_keyboard()
         )
 
+    @instrumented
     async def delete_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Удаление анкеты"""
         user_id = update.effective_user.id
         
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE profiles SET is_active = FALSE WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        await self.remove_profiles(user_id)
         
         await update.message.reply_text(
             "✅ Ваша анкета удалена!",
             reply_markup=self.get_main_menu_keyboard()
         )
 
-    def run(self):
-        """Запуск бота"""
-        application = Application.builder().token(BOT_TOKEN).build()
+    async def create_profile(self, fields, photo=None):
+        """Записать анкету (и метаданные ее фото) и передать ее в ленту изменений снимка"""
+        profile_id, created_at = await self.db.run(self._insert_profile, fields, photo)
+        self.profiles.insert(ProfileRecord(profile_id, *fields, created_at))
+        return profile_id
+
+    async def remove_profiles(self, user_id):
+        """Отключить анкеты пользователя в БД, в снимке и в очередях выдачи"""
+        profile_ids = await self.db.run(self._deactivate_profiles, user_id)
+        for profile_id in profile_ids:
+            self.profiles.delete(profile_id)
+        self.candidates.deactivate(user_id, profile_ids)
+        return profile_ids
+
+    @staticmethod
+    def _save_user(cursor, user_id, username, first_name, last_name):
+        """Сохранить пользователя; смена username попадает в ленту изменений"""
+        row = cursor.execute('SELECT username FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        cursor.execute('''
+            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, username, first_name, last_name))
+        if row is None or row[0] != username:
+            cursor.execute(PROFILE_CHANGE_SQL, ('username', None, user_id, time.time()))
+
+    @staticmethod
+    def _insert_profile(cursor, fields, photo=None):
+        """Создать анкету, вернуть (profile_id, created_at) для снимка.
+
+        photo — [file_unique_id, width, height, file_size] фото анкеты.
+        """
+        profile_id = cursor.execute(INSERT_PROFILE_SQL, fields).lastrowid
+        if photo:
+            file_unique_id, width, height, file_size = photo
+            cursor.execute(PHOTO_INSERT_SQL, (file_unique_id, fields[2], fields[0], width, height, file_size, time.time()))
+        cursor.execute(PROFILE_CHANGE_SQL, ('insert', profile_id, fields[0], time.time()))
+        (created_at,) = cursor.execute(
+            'SELECT created_at FROM profiles WHERE profile_id = ?', (profile_id,)
+        ).fetchone()
+        return profile_id, created_at
+
+    @staticmethod
+    def _deactivate_profiles(cursor, user_id):
+        """Отключить анкеты пользователя, вернуть их profile_id"""
+        rows = cursor.execute(
+            'SELECT profile_id FROM profiles WHERE user_id = ? AND is_active = TRUE', (user_id,)
+        ).fetchall()
+        cursor.execute('UPDATE profiles SET is_active = FALSE WHERE user_id = ?', (user_id,))
+        now = time.time()
+        cursor.executemany(PROFILE_CHANGE_SQL, [('delete', profile_id, user_id, now) for (profile_id,) in rows])
+        return [profile_id for (profile_id,) in rows]
+
+    def register_gauges(self):
+        """Гауги размеров очередей и кэшей"""
+        METRICS.gauge('candidate_queues', lambda: len(self.candidates.users))
+        METRICS.gauge('candidate_queue_depth', lambda: sum(
+            len(entry.cards) for entry in list(self.candidates.users.values())
+        ))
+        METRICS.gauge('user_states_cached', lambda: len(self.user_states))
+        METRICS.gauge('user_states_dirty', lambda: len(self.user_states.dirty))
+        METRICS.gauge('swipes_pending', lambda: len(self.swipes.pending))
+        METRICS.gauge('profiles_in_memory', lambda: len(self.profiles.records))
+        METRICS.gauge('seen_cache_bytes', lambda: self.seen.nbytes)
+        METRICS.gauge('db_queue_depth', lambda: self.db.queue_depth(write=False), (('pool', 'read'),))
+        METRICS.gauge('db_queue_depth', lambda: self.db.queue_depth(write=True), (('pool', 'write'),))
+
+    async def on_startup(self, application: Application):
+        """Запуск фоновых задач после инициализации бота"""
+        self.swipes.start()
+        self.user_states.start()
+        # Изменения, сделанные во время загрузки, применятся повторно: это безопасно
+        (self.last_change_id,) = await self.db.fetchone('SELECT COALESCE(MAX(change_id), 0) FROM profile_changes')
+        count = await self.profiles.load(self.db)
+        logging.info(f"Активных анкет в памяти: {count}")
+        if application is not None:
+            METRICS.gauge('update_queue_depth', application.update_queue.qsize)
+        if METRICS_PORT:
+            self.metrics_server = MetricsServer()
+            port = await self.metrics_server.start(port=METRICS_PORT + self.worker_index)
+            logging.info(f"Метрики: http://{METRICS_LISTEN}:{port}{METRICS_PATH}")
+
+    async def log_metrics(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача JobQueue: сводка метрик в лог"""
+        for line in METRICS.summary():
+            logging.info(f"📈 {line}")
+
+    async def refresh_recommendations(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача JobQueue: пересчитать входящие лайки для недавно активных пользователей"""
+        now = time.monotonic()
+        count = await self.recommender.refresh(self.candidates.active_users(now - RANK_INTERVAL))
+        self.recommender.prune(now - 2 * RANK_INTERVAL)
+        logging.info(f"Рекомендации пересчитаны для {count} пользователей")
+
+    async def deliver_notifications(self, context: ContextTypes.DEFAULT_TYPE):
+        """Задача JobQueue: разослать уведомления о новых мэтчах своим пользователям"""
+        await self.notifier.drain(context.bot, self.worker_index, self.workers)
+
+    async def sync_profiles(self, context: ContextTypes.DEFAULT_TYPE = None):
+        """Задача JobQueue: применить к снимку изменения анкет, сделанные другими воркерами"""
+        changes = await self.db.fetchall(PROFILE_CHANGES_SQL, (self.last_change_id,))
+        if changes:
+            self.last_change_id = changes[-1][0]
+            profiles, usernames = await self.db.run(load_changed, changes, write=False)
+            self.apply_changes(changes, profiles, usernames)
+        if time.time() - self.last_prune > PROFILE_CHANGES_TTL / 10:
+            self.last_prune = time.time()
+            await self.db.execute(
+                'DELETE FROM profile_changes WHERE created_at < ?', (time.time() - PROFILE_CHANGES_TTL,)
+            )
+        return len(changes)
+
+    async def compact_likes(self, context: ContextTypes.DEFAULT_TYPE = None, days=LIKES_ARCHIVE_DAYS):
+        """Задача JobQueue: перенести старые дизлайки в архив, удалить оценки
+        отключенных анкет и вернуть освободившееся место файлу.
+
+        Каждая пачка — отдельная транзакция, так что запись свайпов
+        ждет не дольше одной пачки. Возвращает (перенесено, удалено, страниц).
+        """
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+        archived = 0
+        while True:
+            scanned, moved = await self.db.run(archive_dislikes, cutoff, LIKES_COMPACT_BATCH)
+            archived += moved
+            if scanned < LIKES_COMPACT_BATCH:
+                break
+        pruned = await self.db.run(prune_inactive_likes)
+        freed = await self.db.run(incremental_vacuum, LIKES_VACUUM_PAGES)
+        logging.info(f"Уплотнение лайков: в архив {archived}, удалено {pruned}, освобождено страниц {freed}")
+        return archived, pruned, freed
+
+    async def backup(self, context: ContextTypes.DEFAULT_TYPE = None, backup_dir=BACKUP_DIR):
+        """Задача JobQueue: резервная копия базы в backup_dir.
+
+        Копия снимается в отдельном потоке с пониженным приоритетом, чтобы
+        сжатие и проверка не отнимали процессор у обработчиков.
+        """
+        started = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup', initializer=lower_thread_priority)
+        try:
+            path = await asyncio.get_running_loop().run_in_executor(
+                executor, backup_database, self.db.db_name, backup_dir
+            )
+        finally:
+            executor.shutdown(wait=False)
+        logging.info(
+            f"Резервная копия {path}: {os.path.getsize(path) / 2**20:.1f} МБ "
+            f"за {time.perf_counter() - started:.1f} с"
+        )
+        return path
+
+    def apply_changes(self, changes, profiles, usernames):
+        """Применить изменения к снимку по порядку (повторное применение ничего не меняет)"""
+        for _, kind, profile_id, user_id in changes:
+            if kind == 'insert' and profile_id in profiles:
+                self.profiles.insert(ProfileRecord(*profiles[profile_id]))
+            elif kind == 'delete':
+                self.profiles.delete(profile_id)
+                self.candidates.deactivate(user_id, [profile_id])
+            elif kind == 'username':
+                self.profiles.set_username(user_id, usernames.get(user_id))
+
+    async def on_shutdown(self, application: Application):
+        """Запись оставшихся оценок и состояний, остановка пула потоков БД"""
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        await self.swipes.stop()
+        await self.user_states.stop()
+        self.db.close()
+
+    def build_application(self, token=BOT_TOKEN, request=None, rate_limiter=True):
+        """Приложение со всеми обработчиками.
+
+        request подменяет HTTP-клиент Bot API (например, заглушкой для
+        бенчмарка), rate_limiter=False отключает SendScheduler.
+        """
+        builder = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(PerUserUpdateProcessor())
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+        )
+        if rate_limiter:
+            # Общий лимит бота делится поровну между воркерами
+            builder = builder.rate_limiter(SendScheduler(global_rate=SEND_GLOBAL_RATE / self.workers))
+        if request is not None:
+            builder = builder.request(request).get_updates_request(request)
+        application = builder.build()
 
         # Обработчики команд
         application.add_handler(CommandHandler("start", self.start))
@@ -676,14 +3436,381 @@ class DatingBot:
         # Обработчики callback-запросов
         application.add_handler(CallbackQueryHandler(self.handle_callback, pattern="^gender_"))
         application.add_handler(CallbackQueryHandler(self.handle_callback, pattern="^faculty_"))
-        application.add_handler(CallbackQueryHandler(self.handle_like, pattern="^(like|dislike)$"))
+        application.add_handler(CallbackQueryHandler(self.handle_like, pattern="^(like|dislike)(:|$)"))
+        application.add_handler(CallbackQueryHandler(self.handle_filter_callback, pattern="^pref_"))
+        application.add_handler(CallbackQueryHandler(self.handle_matches_page, pattern=r"^matches_(next|prev)_-?\d+$"))
+
+        # Фоновые задачи: пересчет рекомендаций и уведомления о мэтчах
+        application.job_queue.run_repeating(
+            self.refresh_recommendations, interval=RANK_INTERVAL, first=RANK_INTERVAL
+        )
+        application.job_queue.run_repeating(
+            self.deliver_notifications, interval=OUTBOX_INTERVAL, first=OUTBOX_INTERVAL
+        )
+        application.job_queue.run_repeating(
+            self.sync_profiles, interval=PROFILE_SYNC_INTERVAL, first=PROFILE_SYNC_INTERVAL
+        )
+        # Уплотнение и резервные копии общие для базы, их выполняет только первый воркер
+        if self.worker_index == 0:
+            application.job_queue.run_repeating(
+                self.compact_likes, interval=LIKES_COMPACT_INTERVAL, first=LIKES_COMPACT_INTERVAL
+            )
+            if BACKUP_INTERVAL:
+                application.job_queue.run_repeating(self.backup, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+        if METRICS_LOG_INTERVAL:
+            application.job_queue.run_repeating(
+                self.log_metrics, interval=METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL
+            )
+        return application
+
+    async def serve_webhook(self, application):
+        """Работа через webhook на встроенном HTTP-сервере до SIGINT/SIGTERM"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await application.initialize()
+        # post_init/post_shutdown вызывает только run_polling, здесь - вручную
+        await self.on_startup(application)
+        await application.start()
+        server = WebhookServer(application)
+        port = await server.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        print(f"🌐 Webhook слушает порт {port}, путь {WEBHOOK_PATH}")
+        try:
+            await stop.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            await self.on_shutdown(application)
+            await application.shutdown()
+
+    async def serve_queue(self, queue, token=BOT_TOKEN, request=None):
+        """Режим воркера: обрабатывать обновления (dict) из очереди роутера до None"""
+        application = self.build_application(token, request, rate_limiter=request is None)
+        await application.initialize()
+        await self.on_startup(application)
+        await application.start()
+        loop = asyncio.get_running_loop()
+        try:
+            while (data := await loop.run_in_executor(None, queue.get)) is not None:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            # stop() отбрасывает необработанные обновления, поэтому сначала дожидаемся их
+            await application.update_queue.join()
+        finally:
+            await application.stop()
+            await self.on_shutdown(application)
+            await application.shutdown()
+
+    def run(self):
+        """Запуск бота"""
+        application = self.build_application()
 
         print("🤖 Бот запускается...")
         print("✅ База данных готова")
         print("🚀 Бот работает! Напишите /start в Telegram")
         
-        application.run_polling()
+        if WEBHOOK_URL:
+            asyncio.run(self.serve_webhook(application))
+        else:
+            application.run_polling()
+
+
+def run_workers(workers=WORKERS):
+    """Многопроцессный режим: роутер и workers воркеров"""
+    router = UpdateRouter(workers)
+    router.start()
+    try:
+        asyncio.run(router.serve())
+    finally:
+        router.stop()
+
+
+def update_user_id(data):
+    """user_id автора обновления (0, если его нет): по нему обновление попадает к воркеру"""
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if isinstance(user, dict) and 'id' in user:
+                return user['id']
+    return 0
+
+
+def run_worker(index, workers, queue, db_name=DATABASE_URL, token=BOT_TOKEN, request_class=None):
+    """Процесс-воркер: свой DatingBot, обновления берет из queue.
+
+    request_class - класс HTTP-клиента Bot API (заглушка в проверках),
+    None - обычный клиент.
+    """
+    # Ctrl+C получает вся группа процессов, а останавливает воркеров роутер
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    bot = DatingBot(db_name, index, workers)
+    asyncio.run(bot.serve_queue(queue, token, request_class() if request_class else None))
+
+
+class UpdateRouter:
+    """Родительский процесс многопроцессного режима: раздает обновления воркерам по user_id % workers"""
+
+    def __init__(self, workers=WORKERS, db_name=DATABASE_URL, token=BOT_TOKEN, request_class=None):
+        self.workers = workers
+        self.db_name = db_name
+        self.token = token
+        self.request_class = request_class
+        self.queues = []
+        self.processes = []
+        self.restarted = []
+        self._context = multiprocessing.get_context('spawn')
+
+    def start(self):
+        # Схему мигрирует роутер, чтобы воркеры не делали это одновременно
+        conn = open_database(self.db_name).connect()
+        migrate(conn)
+        conn.close()
+        for index in range(self.workers):
+            self.queues.append(self._context.Queue())
+            self.processes.append(self._spawn(index, self.queues[index]))
+            self.restarted.append(0.0)
+
+    def _spawn(self, index, updates):
+        process = self._context.Process(
+            target=run_worker, name=f'worker-{index}',
+            args=(index, self.workers, updates, self.db_name, self.token, self.request_class)
+        )
+        process.start()
+        return process
+
+    def _restart(self, index):
+        """Запустить упавший воркер заново; недоставленные обновления переходят к нему"""
+        old = self.queues[index]
+        updates = self._context.Queue()
+        # Воркер мог умереть посреди get(), и старая очередь осталась под его
+        # блокировкой: забираем из нее то, что удается, и дальше работаем с новой
+        moved = 0
+        while True:
+            try:
+                updates.put(old.get_nowait())
+            except (queue.Empty, OSError, EOFError):
+                break
+            moved += 1
+        logging.error(
+            f"Воркер {index} завершился с кодом {self.processes[index].exitcode}, "
+            f"перезапускаем; из его очереди перенесено обновлений: {moved}"
+        )
+        self.queues[index] = updates
+        self.processes[index] = self._spawn(index, updates)
+        self.restarted[index] = time.monotonic()
+
+    def route(self, data):
+        index = update_user_id(data) % self.workers
+        if (not self.processes[index].is_alive()
+                and time.monotonic() - self.restarted[index] > WORKER_RESTART_DELAY):
+            self._restart(index)
+        self.queues[index].put(data)
+
+    async def deliver(self, data):
+        self.route(data)
+
+    def stop(self):
+        """Дождаться, пока воркеры обработают свои очереди, и остановить их"""
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join()
+        return [process.exitcode for process in self.processes]
+
+    async def serve(self):
+        """Получать обновления через webhook или long polling до SIGINT/SIGTERM"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        bot = Bot(self.token)
+        await bot.initialize()
+        try:
+            if WEBHOOK_URL:
+                server = WebhookServer(deliver=self.deliver)
+                port = await server.start()
+                await bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+                print(f"🌐 Webhook слушает порт {port}, путь {WEBHOOK_PATH}, воркеров: {self.workers}")
+                await stop.wait()
+                await server.stop()
+            else:
+                await bot.delete_webhook()
+                print(f"🔄 Long polling, воркеров: {self.workers}")
+                offset = 0
+                delay = POLL_RETRY_DELAY
+                while not stop.is_set():
+                    poll = asyncio.ensure_future(
+                        bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+                    )
+                    done, _ = await asyncio.wait({poll, asyncio.ensure_future(stop.wait())},
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    if poll not in done:
+                        poll.cancel()
+                        break
+                    try:
+                        updates = poll.result()
+                    except (NetworkError, RetryAfter) as e:
+                        pause = e.retry_after if isinstance(e, RetryAfter) else delay
+                        logging.warning(f"Ошибка long polling: {e}; повтор через {pause:.1f} с")
+                        delay = min(delay * 2, POLL_RETRY_MAX_DELAY)
+                        try:
+                            await asyncio.wait_for(stop.wait(), pause)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    delay = POLL_RETRY_DELAY
+                    for update in updates:
+                        self.route(update.to_dict())
+                        offset = update.update_id + 1
+                # Подтвердить последние полученные обновления
+                try:
+                    await bot.get_updates(offset=offset, timeout=0)
+                except NetworkError as e:
+                    logging.warning(f"Не удалось подтвердить последние обновления: {e}")
+        finally:
+            await bot.shutdown()
+
+
+def backfill_matches_command(db_name='dating_bot.db'):
+    """python bot.py backfill-matches: пересобрать мэтчи из истории лайков"""
+    conn = sqlite3.connect(db_name)
+    migrate(conn)
+    with conn:
+        count = backfill_matches(conn.cursor())
+    conn.close()
+    print(f"✅ Мэтчей восстановлено: {count}")
+    return 0
+
+
+def compact_likes_command(db_name='dating_bot.db', days=str(LIKES_ARCHIVE_DAYS)):
+    """python bot.py compact-likes [DB] [ДНИ]: уплотнить историю оценок целиком и сравнить до/после.
+
+    Переносит в архив дизлайки старше ДНИ дней, удаляет оценки отключенных
+    анкет и возвращает место файлу. База, созданная до режима
+    auto_vacuum = INCREMENTAL, переводится в него полным VACUUM — это
+    стоит делать на остановленном боте. Печатает размер файла, число строк
+    likes и время запросов «уже оценено» и проверки взаимности на выборке
+    пользователей, и проверяет, что множество оцененных активных анкет
+    у них не изменилось.
+    """
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    migrate(conn)
+    users = [user_id for (user_id,) in conn.execute(
+        'SELECT DISTINCT from_user_id FROM likes ORDER BY RANDOM() LIMIT 500'
+    )]
+    active = {profile_id for (profile_id,) in conn.execute(
+        'SELECT profile_id FROM profiles WHERE is_active = TRUE'
+    )}
+    owners = dict(conn.execute('SELECT profile_id, user_id FROM profiles'))
+
+    def seen_sets():
+        sets = {}
+        for user_id in users:
+            seen = set()
+            for profile_id, archived in conn.execute(SEEN_BY_USER_SQL, (user_id, user_id)):
+                seen.update(unpack_profile_ids(archived) if archived is not None else (profile_id,))
+            sets[user_id] = seen & active
+        return sets
+
+    def measure(title):
+        (pages,) = conn.execute('PRAGMA page_count').fetchone()
+        (page_size,) = conn.execute('PRAGMA page_size').fetchone()
+        (rows,) = conn.execute('SELECT COUNT(*) FROM likes').fetchone()
+        started = time.perf_counter()
+        sets = seen_sets()
+        seen_ms = (time.perf_counter() - started) / max(len(users), 1) * 1000
+        started = time.perf_counter()
+        for user_id in users:
+            for profile_id in list(sets[user_id])[:5]:
+                conn.execute(MUTUAL_LIKE_SQL, (owners[profile_id], user_id)).fetchone()
+        mutual_ms = (time.perf_counter() - started) / max(len(users) * 5, 1) * 1000
+        print(f"{title}: файл {pages * page_size / 2**20:.1f} МБ, likes {rows} строк, "
+              f"«уже оценено» {seen_ms:.3f} мс, взаимность {mutual_ms:.3f} мс")
+        return sets
+
+    before = measure("До")
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - float(days) * 86400))
+    archived = 0
+    while True:
+        conn.execute('BEGIN')
+        scanned, moved = archive_dislikes(conn.cursor(), cutoff, LIKES_COMPACT_BATCH)
+        conn.execute('COMMIT')
+        archived += moved
+        if scanned < LIKES_COMPACT_BATCH:
+            break
+    conn.execute('BEGIN')
+    pruned = prune_inactive_likes(conn.cursor())
+    conn.execute('COMMIT')
+    (mode,) = conn.execute('PRAGMA auto_vacuum').fetchone()
+    if mode != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    else:
+        conn.executescript('PRAGMA incremental_vacuum')
+    print(f"В архив: {archived}, удалено оценок отключенных анкет: {pruned}")
+    after = measure("После")
+    conn.close()
+    if before != after:
+        print("❌ Множество оцененных анкет изменилось")
+        return 1
+    print(f"✅ Оцененные анкеты {len(users)} пользователей совпадают")
+    return 0
+
+
+def backup_command(db_name='dating_bot.db', backup_dir=BACKUP_DIR):
+    """python bot.py backup [DB] [DIR]: резервная копия работающей базы"""
+    started = time.perf_counter()
+    path = backup_database(db_name, backup_dir)
+    print(f"✅ {path}: {os.path.getsize(path) / 2**20:.1f} МБ за {time.perf_counter() - started:.1f} с")
+    return 0
+
+
+def restore_backup_command(path, db_name='dating_bot.db'):
+    """python bot.py restore-backup КОПИЯ [DB]: заменить базу копией (бот должен быть остановлен)"""
+    version = restore_backup(path, db_name)
+    print(f"✅ База {db_name} восстановлена из {path}, версия схемы: {version}")
+    return 0
+
+
+def export_stats_command(db_name='dating_bot.db', out_dir=EXPORT_DIR, days=str(LIKES_ARCHIVE_DAYS)):
+    """python bot.py export-stats [DB] [DIR] [ДНИ]: дневная статистика свайпов и мэтчей в CSV.
+
+    swipes_by_faculty.csv — свайпы и доля лайков по факультету анкеты,
+    matches_by_age.csv — свайпы, лайки и мэтчи по возрастной группе
+    пользователя. Можно запускать на работающей базе.
+    """
+    started = time.perf_counter()
+    for path in export_stats(db_name, out_dir, float(days)):
+        with open(path, encoding='utf-8') as f:
+            rows = sum(1 for _ in f) - 1
+        print(f"✅ {path}: {rows} строк")
+    print(f"Выгрузка заняла {time.perf_counter() - started:.1f} с")
+    return 0
+
 
 if __name__ == "__main__":
-    bot = DatingBot()
-    bot.run()
+    commands = {
+        'backfill-matches': backfill_matches_command,
+        'compact-likes': compact_likes_command,
+        'backup': backup_command,
+        'restore-backup': restore_backup_command,
+        'export-stats': export_stats_command,
+    }
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        sys.exit(commands[sys.argv[1]](*sys.argv[2:]))
+    if WORKERS > 1:
+        run_workers()
+    else:
+        bot = DatingBot()
+        bot.run()